@@ -0,0 +1,182 @@
+"""
+AsyncIGAPIExtractor pulls the same feeds as IGAPIExtractor on a Tornado IOLoop,
+so many feeds, and extractors for many API keys, can be multiplexed on one
+thread instead of each blocking on its own. Transformers and outputs are not
+async aware, each feed runs them on a thread of its own, so outputs see every
+call of a feed on the thread that started them. Requires tornado.
+
+	extractors = [AsyncIGAPIExtractor(API_KEY=key, executor=executor) for key in keys]
+	IOLoop.current().run_sync(lambda: gen.multi([e.load_feeds_into(feeds[e]) for e in extractors]))
+"""
+import itertools
+import json
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+
+from graphite.extract.base import IGAPIExtractor, FEEDS
+from graphite.extract.checkpoint import CommitTracker
+from graphite.extract.retry import PageFetchError
+
+
+class AsyncIGAPIExtractor(IGAPIExtractor):
+	client = None
+	executor = None
+
+	def __init__(self, executor=None, **options):
+		super(AsyncIGAPIExtractor, self).__init__(**options)
+		self.executor = executor
+		if self.executor is None:
+			self.executor = ThreadPoolExecutor(max_workers=self._options["pool_size"])
+		self.client = AsyncHTTPClient(force_instance=True, max_clients=self._options["pool_size"])
+
+	@gen.coroutine
+	def fetch_page(self, url, feed):
+		"""
+		Resolves to the (records, next) of one page.
+		"""
+		cache = self._options["page_cache"]
+		if cache is not None and self._options["replay"]:
+			page = yield self.executor.submit(self._replay_page, cache, url, feed)
+			raise gen.Return(page)
+		# Make multiple attempts, since the server can sometimes timeout the
+		# transaction after 60 seconds.
+		policy = self._retry_policy()
+		timeout = policy.timeout or self._options["request_timeout"]
+		for attempt in itertools.count(start=1):
+			print >> sys.stderr, url, feed
+			self._count("requests")
+			response = yield self.client.fetch(url, raise_error=False,
+				request_timeout=timeout, decompress_response=True)
+			retry_after = None
+			# 599 is how tornado reports connection errors and timeouts
+			if response.code == 599:
+				if not policy.should_retry(attempt):
+					response.rethrow()
+			elif policy.retry_status(response.code):
+				print >> sys.stderr, "retryable response code", response.code
+				if not policy.should_retry(attempt):
+					raise PageFetchError("response code %s from %s after %d attempts" % (response.code, url, attempt))
+				retry_after = policy.parse_retry_after(response.headers.get("Retry-After"))
+			else:
+				break
+			yield gen.sleep(self._backoff(policy, attempt, retry_after))
+		if response.code == 200:
+			if cache is not None:
+				yield self.executor.submit(cache.put, feed, url, response.body)
+			# Decode off the loop, user pages can be large
+			page = yield self.executor.submit(json.loads, response.body)
+			raise gen.Return(self._parse_page(page, feed))
+		raise PageFetchError("unexpected response code %s from %s" % (response.code, url))
+
+	def pages(self, feed, checkpoint=None):
+		return AsyncFeedPages(self, feed, checkpoint)
+
+	@gen.coroutine
+	def load_feed_into(self, feed, transformer, output, checkpoint_callback=None, checkpoint=None):
+		node_type = FEEDS[feed]
+		print >> sys.stderr, ".. loading %s feed" % feed
+		store = self._options["checkpoint_store"]
+		if checkpoint is None and store is not None:
+			checkpoint = yield self.executor.submit(store.get, feed)
+			if checkpoint:
+				print >> sys.stderr, "resuming %s feed after %s" % (feed, checkpoint)
+		# Outputs like SqliteOutput may only be used on the thread that
+		# started them, so the output calls don't go to the shared executor
+		output_executor = ThreadPoolExecutor(max_workers=1)
+		try:
+			yield output_executor.submit(output.start, node_type)
+			pages = self.pages(feed, checkpoint)
+			next_page = pages.next_page()
+			commits = CommitTracker()
+			while True:
+				page = yield next_page
+				if page is None:
+					break
+				# Request the following page while this one is transformed and loaded
+				next_page = pages.next_page()
+				page_url, data, next = page
+				if page_url and checkpoint_callback:
+					checkpoint_callback(self.extract_checkpoint(page_url))
+				committed = yield output_executor.submit(self.process_set, node_type, data, transformer, output)
+				if store is not None and next:
+					# Record where to pick up from once the page is committed
+					cursor = commits.page(committed, next)
+					if cursor:
+						yield self.executor.submit(store.set, feed, self.extract_checkpoint(cursor))
+			completed = yield output_executor.submit(output.complete)
+		finally:
+			output_executor.shutdown(wait=False)
+		cursor = commits.completed()
+		if store is not None and cursor and completed is not False:
+			yield self.executor.submit(store.set, feed, self.extract_checkpoint(cursor))
+
+	@gen.coroutine
+	def load_feeds_into(self, feeds, checkpoint_callbacks=None):
+		"""
+		Loads several feeds concurrently, feeds maps a feed name to a
+		(transformer, output) pair as in IGAPIExtractor.load_feeds_into.
+		"""
+		checkpoint_callbacks = checkpoint_callbacks or {}
+		for feed in feeds:
+			if feed not in FEEDS:
+				raise ValueError("unknown feed %s" % feed)
+		yield gen.multi([
+			self.load_feed_into(feed, transformer, output, checkpoint_callbacks.get(feed))
+			for feed, (transformer, output) in feeds.items()
+		])
+
+	def close(self):
+		self.client.close()
+		super(AsyncIGAPIExtractor, self).close()
+
+
+class AsyncFeedPages(object):
+	"""
+	Async cursor over the pages of a feed, following the next cursor the same
+	way IGAPIExtractor does.
+
+		page = yield pages.next_page()
+
+	resolves to (page_url, records, next), page_url is None for the first page,
+	and to None once the feed is drained.
+	"""
+	extractor = None
+	feed = None
+
+	def __init__(self, extractor, feed, checkpoint=None):
+		self.extractor = extractor
+		self.feed = feed
+		self.checkpoint = checkpoint
+		self.cursor = None
+		self.started = False
+		self.done = False
+		self.pages_loaded = 0
+
+	@gen.coroutine
+	def next_page(self):
+		if self.done:
+			raise gen.Return(None)
+		extractor = self.extractor
+		if not self.started:
+			self.started = True
+			page_url = None
+			data, next = yield extractor.fetch_page(extractor._feed_url(self.feed, self.checkpoint), self.feed)
+		else:
+			page_url = self.cursor
+			print >> sys.stderr, "loading another page"
+			data, next = yield extractor.fetch_page(extractor._next_page_url(page_url), self.feed)
+		cursor = next
+		if page_url is not None:
+			self.pages_loaded += 1
+			pages_to_load = extractor._options.get("pages_to_load", 0)
+			if pages_to_load > 0 and pages_to_load >= self.pages_loaded:
+				# limiter
+				cursor = None
+		if not cursor or cursor == page_url:
+			self.done = True
+		else:
+			self.cursor = cursor
+		raise gen.Return((page_url, data, next))
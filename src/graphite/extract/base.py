@@ -1,143 +1,391 @@
 """
 IGAPIExtractor loads data from the 8thBridge Graphite Interest Graph API. By default all data is laoded, you can optionaly pass in an offset to only load data that is newer than the offset.
 """
+import copy
 import itertools
+import json
+import Queue
 import sys
+import threading
 import time
 import urllib
 import urlparse
 
 import requests
-from requests.exceptions import ConnectionError
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
 
 from graphite import (NODE_TYPE_USER, NODE_TYPE_FRIEND, NODE_TYPE_ACTION,
 	NODE_TYPE_SALE, NODE_TYPE_OBJECT, NODE_TYPE_USER_BOARD, NODE_TYPE_BRAND_BOARD,
 	NODE_TYPE_FOLLOW, NODE_TYPE_USER_LIKE)
+from graphite.extract.checkpoint import CommitTracker
+from graphite.extract.prefetch import PagePrefetcher
+from graphite.load import output_handle_batch, output_handle_columns
+from graphite.transform import handle_batch, flatten_results
+from graphite.extract.retry import RetryPolicy, PageFetchError
+from graphite.extract.streaming import StreamedPage, ijson
+
+
+# Feed name to the node type its records are handled as
+FEEDS = {
+	"users": NODE_TYPE_USER,
+	"friends": NODE_TYPE_FRIEND,
+	"objects": NODE_TYPE_OBJECT,
+	"actions": NODE_TYPE_ACTION,
+	"sales": NODE_TYPE_SALE,
+	"user_boards": NODE_TYPE_USER_BOARD,
+	"brand_boards": NODE_TYPE_BRAND_BOARD,
+	"curate_follows": NODE_TYPE_FOLLOW,
+	"user_likes": NODE_TYPE_USER_LIKE,
+}
+
+# Feed name to the response key holding the page records
+FEED_KEYS = {
+	"users": "users",
+	"friends": "friends",
+	"objects": "objects",
+	"user_boards": "user_boards",
+	"brand_boards": "brand_boards",
+	"likes": "likes",
+	"sales": "sales",
+	"actions": "users",
+	"user_likes": "likes",
+	"curate_follows": "follows",
+}
 
 
 class IGAPIExtractor(object):
+	"""
+	Options are per instance, _options on the class only holds the defaults.
+
+	Thread safety: an extractor loads one feed at a time, so give each thread
+	its own extractor (load_feeds_into runs every feed on a copy). Separate
+	extractors, including ones for different API keys, can run concurrently in
+	one process. The stats counters, PageCache and checkpoint stores may be
+	shared between threads; outputs may only be shared when wrapped in
+	graphite.load.SynchronizedOutput.
+	"""
 	_options = {
 		"API_HOST": "api.strcst.net",
 		"API_VERSION": "v1",
 		"pages_to_load": 0,
 		"limit_per_page": None,
+		# Default checkpoint for feeds that have none passed in or stored
 		"checkpoint": None,
+		# Checkpoint store that committed feed cursors are recorded in and resumed from
+		"checkpoint_store": None,
+		# Number of pages to fetch ahead on a background thread, 0 disables prefetching
+		"prefetch_pages": 0,
+		# HTTP session settings, connections are pooled and kept alive between pages
+		"pool_size": 4,
+		"request_timeout": 90,
+		"accept_encoding": "gzip, deflate",
+		# Decode page records incrementally as they arrive, requires ijson
+		"stream_pages": False,
+		# RetryPolicy used for page requests, None uses the default policy
+		"retry_policy": None,
+		# PageCache that raw page bodies are written to, with replay pages are
+		# only read from the cache and the API is never contacted
+		"page_cache": None,
+		"replay": False,
 	}
+	session = None
+	stats = None
 
 	def __init__(self, **options):
-		# TODO: checkpoint should be specified in load_*_into() methods, not constructor options 
-		self._options.update(options)
+		self._options = dict(self._options, **options)
+		self.stats = {"requests": 0, "retries": 0, "backoff_seconds": 0.0}
+		self.stats_lock = threading.Lock()
+
+	def _count(self, name, amount=1):
+		with self.stats_lock:
+			self.stats[name] += amount
+
+	def _retry_policy(self):
+		return self._options["retry_policy"] or RetryPolicy()
+
+	def _backoff(self, policy, attempt, retry_after=None):
+		delay = policy.backoff(attempt, retry_after)
+		self._count("retries")
+		self._count("backoff_seconds", delay)
+		print >> sys.stderr, "retrying in %.1f seconds" % delay
+		return delay
 
-	def _load_feed(self, feed):
+	def _get_session(self):
+		if self.session is None:
+			pool_size = self._options["pool_size"]
+			session = requests.Session()
+			adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+			session.mount("https://", adapter)
+			session.mount("http://", adapter)
+			session.headers.update({
+				"Accept-Encoding": self._options["accept_encoding"],
+				"Connection": "keep-alive",
+			})
+			self.session = session
+		return self.session
+
+	def close(self):
+		if self.session is not None:
+			self.session.close()
+			self.session = None
+
+	def _load_feed(self, feed, checkpoint=None):
+		return self._load_data_from(self._feed_url(feed, checkpoint), feed)
+
+	def _feed_url(self, feed, checkpoint=None):
 		url = "https://%(API_HOST)s/%(API_VERSION)s/igapi/%(API_KEY)s/" % self._options
 		url += feed
 		params = {}
 		if self._options["limit_per_page"]:
 			params["bl"] = self._options["limit_per_page"]
-		if self._options["checkpoint"]:
-			params["after"] = self._options["checkpoint"]
+		checkpoint = checkpoint or self._options["checkpoint"]
+		if checkpoint:
+			params["after"] = checkpoint
 		if params:
 			url += "?" + urllib.urlencode(params) 
-		return self._load_data_from(url, feed)
+		return url
 
 	def _load_data_from(self, url, feed):
 		# Make multiple attempts, since the server can sometimes timeout the 
 		# transaction after 60 seconds.
-		for i in itertools.count(start=1):
+		cache = self._options["page_cache"]
+		if cache is not None and self._options["replay"]:
+			return self._replay_page(cache, url, feed)
+		policy = self._retry_policy()
+		timeout = policy.timeout or self._options["request_timeout"]
+		# Cached pages are stored whole, so they are not streamed
+		stream = self._stream_pages() and cache is None
+		for attempt in itertools.count(start=1):
+			retry_after = None
 			try:
 				print >> sys.stderr, url, feed
-				response = requests.get(url)
-				break
-			except ConnectionError:
-				if i == 10:
+				self._count("requests")
+				response = self._get_session().get(url, timeout=timeout, stream=stream)
+				if not policy.retry_status(response.status_code):
+					break
+				print >> sys.stderr, "retryable response code", response.status_code
+				retry_after = policy.parse_retry_after(response.headers.get("Retry-After"))
+				response.close()
+				if not policy.should_retry(attempt):
+					raise PageFetchError("response code %s from %s after %d attempts" % (response.status_code, url, attempt))
+			except (ConnectionError, Timeout):
+				if not policy.should_retry(attempt):
 					raise
-				time.sleep(60)
+			time.sleep(self._backoff(policy, attempt, retry_after))
 		if response.status_code == 200:
-			json = response.json()
-			if json.get("status") == "OK":
-				if feed in ["users", "friends", "objects", "user_boards", "brand_boards", "likes", "sales"]:
-					return json.get(feed, []), json.get("next")
-				elif feed == "actions":
-					return json.get("users", []), json.get("next")
-				elif feed == "user_likes":
-					return json.get("likes", []), json.get("next")
-				elif feed == "curate_follows":
-					return json.get("follows", []), json.get("next")
-				else:
-					print >> sys.stderr, "feed was not what we thought", feed
-			else:
-				print >> sys.stderr, "unexpected status code", json.get("status")
-		else:
-			print >> sys.stderr, "unexpected response code", response.status_code
+			if stream:
+				if feed in FEED_KEYS:
+					return StreamedPage(response, FEED_KEYS[feed]), None
+				print >> sys.stderr, "feed was not what we thought", feed
+				response.close()
+				return [], None
+			if cache is not None:
+				body = response.content
+				cache.put(feed, url, body)
+				return self._parse_page(json.loads(body), feed)
+			return self._parse_page(response.json(), feed)
+		response.close()
+		# Ending the feed here would silently skip the rest of it
+		raise PageFetchError("unexpected response code %s from %s" % (response.status_code, url))
+
+	def _replay_page(self, cache, url, feed):
+		print >> sys.stderr, "replaying", url, feed
+		body = cache.get(feed, url)
+		if body is None:
+			# Evicted or never recorded, ending the feed here would truncate it
+			raise PageFetchError("page not in cache %s" % url)
+		return self._parse_page(json.loads(body), feed)
+
+	@staticmethod
+	def _parse_page(json, feed):
+		if json.get("status") != "OK":
+			raise PageFetchError("unexpected status %r for %s feed" % (json.get("status"), feed))
+		if feed in FEED_KEYS:
+			return json.get(FEED_KEYS[feed], []), json.get("next")
+		print >> sys.stderr, "feed was not what we thought", feed
 		return [], None
 
-	def load_users_into(self, transformer, output, checkpoint_callback=None):
-		self._load_feed_into("users", NODE_TYPE_USER, transformer, output, checkpoint_callback)
+	def _stream_pages(self):
+		if self._options["stream_pages"] and ijson is None:
+			print >> sys.stderr, "ijson is not installed, pages will not be streamed"
+			return False
+		return self._options["stream_pages"]
 
-	def load_friends_into(self, transformer, output, checkpoint_callback=None):
-		self._load_feed_into("friends", NODE_TYPE_FRIEND, transformer, output, checkpoint_callback)
+	def load_users_into(self, transformer, output, checkpoint_callback=None, checkpoint=None):
+		self._load_feed_into("users", NODE_TYPE_USER, transformer, output, checkpoint_callback, checkpoint)
 
-	def load_objects_into(self, transformer, output, checkpoint_callback=None):
-		self._load_feed_into("objects", NODE_TYPE_OBJECT, transformer, output, checkpoint_callback)
+	def load_friends_into(self, transformer, output, checkpoint_callback=None, checkpoint=None):
+		self._load_feed_into("friends", NODE_TYPE_FRIEND, transformer, output, checkpoint_callback, checkpoint)
 
-	def load_actions_into(self, transformer, output, checkpoint_callback=None):
-		self._load_feed_into("actions", NODE_TYPE_ACTION, transformer, output, checkpoint_callback)
+	def load_objects_into(self, transformer, output, checkpoint_callback=None, checkpoint=None):
+		self._load_feed_into("objects", NODE_TYPE_OBJECT, transformer, output, checkpoint_callback, checkpoint)
 
-	def load_sales_into(self, transformer, output, checkpoint_callback=None):
-		self._load_feed_into("sales", NODE_TYPE_SALE, transformer, output, checkpoint_callback)
+	def load_actions_into(self, transformer, output, checkpoint_callback=None, checkpoint=None):
+		self._load_feed_into("actions", NODE_TYPE_ACTION, transformer, output, checkpoint_callback, checkpoint)
 
-	def load_user_boards_into(self, transformer, output, checkpoint_callback=None):
-		self._load_feed_into("user_boards", NODE_TYPE_USER_BOARD, transformer, output, checkpoint_callback)
+	def load_sales_into(self, transformer, output, checkpoint_callback=None, checkpoint=None):
+		self._load_feed_into("sales", NODE_TYPE_SALE, transformer, output, checkpoint_callback, checkpoint)
 
-	def load_brand_boards_into(self, transformer, output, checkpoint_callback=None):
-		self._load_feed_into("brand_boards", NODE_TYPE_BRAND_BOARD, transformer, output, checkpoint_callback)
+	def load_user_boards_into(self, transformer, output, checkpoint_callback=None, checkpoint=None):
+		self._load_feed_into("user_boards", NODE_TYPE_USER_BOARD, transformer, output, checkpoint_callback, checkpoint)
 
-	def load_follows_into(self, transformer, output, checkpoint_callback=None):
-		self._load_feed_into("curate_follows", NODE_TYPE_FOLLOW, transformer, output, checkpoint_callback)
+	def load_brand_boards_into(self, transformer, output, checkpoint_callback=None, checkpoint=None):
+		self._load_feed_into("brand_boards", NODE_TYPE_BRAND_BOARD, transformer, output, checkpoint_callback, checkpoint)
 
-	def load_user_likes_into(self, transformer, output, checkpoint_callback=None):
-		self._load_feed_into("user_likes", NODE_TYPE_USER_LIKE, transformer, output, checkpoint_callback)
+	def load_follows_into(self, transformer, output, checkpoint_callback=None, checkpoint=None):
+		self._load_feed_into("curate_follows", NODE_TYPE_FOLLOW, transformer, output, checkpoint_callback, checkpoint)
 
-	def _load_feed_into(self, feed, node_type, transformer, output, checkpoint_callback):
+	def load_user_likes_into(self, transformer, output, checkpoint_callback=None, checkpoint=None):
+		self._load_feed_into("user_likes", NODE_TYPE_USER_LIKE, transformer, output, checkpoint_callback, checkpoint)
+
+	def load_feeds_into(self, feeds, max_workers=4, checkpoint_callbacks=None):
+		"""
+		Loads several feeds concurrently. feeds maps a feed name (see FEEDS) to
+		a (transformer, output) pair. Each feed is pulled on its own extractor
+		copy and HTTP session; an output shared by several feeds must be
+		thread-safe, e.g. wrapped in graphite.load.SynchronizedOutput.
+		At most max_workers feeds are loaded at once. checkpoint_callbacks
+		optionally maps a feed name to its checkpoint_callback. The first
+		failure is re-raised once all feeds have finished.
+		"""
+		checkpoint_callbacks = checkpoint_callbacks or {}
+		for feed in feeds:
+			if feed not in FEEDS:
+				raise ValueError("unknown feed %s" % feed)
+		pending = Queue.Queue()
+		for feed in feeds:
+			pending.put(feed)
+		errors = []
+
+		def worker():
+			while True:
+				try:
+					feed = pending.get_nowait()
+				except Queue.Empty:
+					return
+				transformer, output = feeds[feed]
+				extractor = copy.copy(self)
+				extractor._options = dict(self._options)
+				extractor.session = None
+				try:
+					extractor._load_feed_into(feed, FEEDS[feed], transformer, output, checkpoint_callbacks.get(feed))
+				except Exception:
+					print >> sys.stderr, "failed loading %s feed" % feed, sys.exc_info()[1]
+					errors.append(sys.exc_info())
+				finally:
+					extractor.close()
+
+		threads = []
+		for i in range(max(1, min(max_workers, len(feeds)))):
+			thread = threading.Thread(target=worker, name="graphite-feed-%d" % i)
+			thread.daemon = True
+			thread.start()
+			threads.append(thread)
+		for thread in threads:
+			thread.join()
+		if errors:
+			raise errors[0][0], errors[0][1], errors[0][2]
+
+	def _load_feed_into(self, feed, node_type, transformer, output, checkpoint_callback, checkpoint=None):
 		print >> sys.stderr, ".. loading %s feed" % feed
+		store = self._options["checkpoint_store"]
+		if checkpoint is None and store is not None:
+			checkpoint = store.get(feed)
+			if checkpoint:
+				print >> sys.stderr, "resuming %s feed after %s" % (feed, checkpoint)
 		output.start(node_type)
-		data, next = self._load_feed(feed)
-		self.process_set(node_type, data, transformer, output)
+		prefetch_pages = self._options.get("prefetch_pages", 0)
+		if prefetch_pages > 0:
+			# Fetch up to prefetch_pages ahead while this thread transforms and loads
+			pages = PagePrefetcher(self._iter_pages(feed, checkpoint, buffered=True), prefetch_pages)
+		else:
+			pages = self._iter_pages(feed, checkpoint)
+		# Cursors are only recorded once the page before them is committed,
+		# outputs batching pages or writing in the background commit later
+		commits = CommitTracker()
+		try:
+			for page_url, data, next in pages:
+				if page_url and checkpoint_callback:
+					checkpoint_callback(self.extract_checkpoint(page_url))
+				committed = self.process_set(node_type, data, transformer, output)
+				next = self._page_next(data, next)
+				if store is not None and next:
+					cursor = commits.page(committed, next)
+					if cursor:
+						store.set(feed, self.extract_checkpoint(cursor))
+		finally:
+			# Stop a prefetcher right away when loading a page fails
+			pages.close()
+		completed = output.complete()
+		cursor = commits.completed()
+		if store is not None and cursor and completed is not False:
+			store.set(feed, self.extract_checkpoint(cursor))
+
+	def _iter_pages(self, feed, checkpoint=None, buffered=False):
+		"""
+		Yields (page_url, records, next) for every page of the feed, following
+		the next cursor. page_url is None for the first page. A streamed page
+		has to be read through before the next one is requested and its next
+		is only known then, pass buffered when pages are consumed after the
+		generator has moved on.
+		"""
+		data, next = self._read_page(self._load_feed(feed, checkpoint), buffered)
+		yield None, data, next
+		next = self._page_next(data, next)
 		pages_loaded = 0
 		pages_to_load = self._options.get("pages_to_load", 0)
 		prev_next = None
 		while next and next != prev_next:
 			prev_next = next
 			print >> sys.stderr, "loading another page"
-			if checkpoint_callback:
-				checkpoint_callback(self.extract_checkpoint(next))
-			if self._options["limit_per_page"]:
-				next += "&bl=%d" % self._options["limit_per_page"]
-			data, next = self._load_data_from(next, feed)
-			self.process_set(node_type, data, transformer, output)
+			page_url = next
+			data, next = self._read_page(self._load_data_from(self._next_page_url(next), feed), buffered)
+			yield page_url, data, next
+			next = self._page_next(data, next)
 			pages_loaded += 1
 
 			if pages_to_load > 0 and pages_to_load >= pages_loaded:
 				# limiter
 				next = None
-		output.complete()
+
+	def _next_page_url(self, next):
+		if self._options["limit_per_page"]:
+			next += "&bl=%d" % self._options["limit_per_page"]
+		return next
+
+	@staticmethod
+	def _read_page(page, buffered):
+		data, next = page
+		if buffered and isinstance(data, StreamedPage):
+			data = list(data)
+			next = page[0].next
+		return data, next
+
+	@staticmethod
+	def _page_next(data, next):
+		# The cursor of a streamed page is only known once it has been read
+		if isinstance(data, StreamedPage):
+			return data.next
+		return next
 
 	def process_set(self, type, data, transformer, output):
-		print >> sys.stderr, "processing %s data, %s records" % (type, len(data),)
-		for item in data:
-			if type == NODE_TYPE_USER_LIKE:
-				id = item.get("user")
-			else:
-				id = item.get("id")
-			result = transformer.handle(type, id, item)
-			if result is not None:
-				if isinstance(result, dict):
-					output.handle(type, id, result)
-				else:
-
-					for item in result:
-						output.handle(type, id, item)
-		output.commit()
+		if isinstance(data, StreamedPage):
+			print >> sys.stderr, "processing %s data, streamed records" % (type,)
+		else:
+			print >> sys.stderr, "processing %s data, %s records" % (type, len(data),)
+		id_key = "user" if type == NODE_TYPE_USER_LIKE else "id"
+		items = ((item.get(id_key), item) for item in data)
+		handle_columns = getattr(transformer, "handle_columns", None)
+		if handle_columns is not None:
+			# Columnar transformers hand the whole page over as one ColumnBatch
+			output_handle_columns(output, type, handle_columns(type, items))
+		else:
+			results = handle_batch(transformer, type, items)
+			output_handle_batch(output, type, flatten_results(results))
+		# False when the output holds the page in an open transaction, a
+		# PendingCommit when it is committed on a writer thread
+		return output.commit()
 		
 	@staticmethod
 	def extract_checkpoint(next_url):
@@ -0,0 +1,95 @@
+"""
+PageCache keeps raw feed page bodies gzipped in a local directory, keyed by the
+feed and its cursor, so an extraction can be replayed from disk without
+touching the API. The least recently used pages are evicted once the cache
+grows past max_bytes.
+"""
+import gzip
+import hashlib
+import os
+import sys
+import threading
+import urlparse
+
+
+class PageCache(object):
+	directory = None
+	max_bytes = None
+
+	def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.lock = threading.Lock()
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+		self.size = sum(size for path, mtime, size in self._entries())
+
+	def _path(self, feed, url):
+		# The url path carries the API key, so tenants can share a directory
+		parts = urlparse.urlparse(url)
+		query = urlparse.parse_qs(parts.query)
+		after = query.get("after", [""])[0]
+		# next urls may carry bl twice, the last one wins
+		bl = query.get("bl", [""])[-1]
+		digest = hashlib.sha1("\n".join([parts.netloc, parts.path, after, bl])).hexdigest()
+		return os.path.join(self.directory, "%s-%s.json.gz" % (feed, digest))
+
+	def _entries(self):
+		for name in os.listdir(self.directory):
+			if name.endswith(".json.gz"):
+				path = os.path.join(self.directory, name)
+				try:
+					stat = os.stat(path)
+				except OSError:
+					continue
+				yield path, stat.st_mtime, stat.st_size
+
+	def get(self, feed, url):
+		"""
+		Returns the cached page body, or None.
+		"""
+		path = self._path(feed, url)
+		try:
+			f = gzip.open(path, "rb")
+		except IOError:
+			return None
+		try:
+			body = f.read()
+		except IOError as e:
+			print >> sys.stderr, "unreadable cached page", path, e
+			return None
+		finally:
+			f.close()
+		# Mark as recently used for eviction
+		try:
+			os.utime(path, None)
+		except OSError:
+			pass
+		return body
+
+	def put(self, feed, url, body):
+		path = self._path(feed, url)
+		tmp_path = "%s.%s.tmp" % (path, threading.current_thread().ident)
+		f = gzip.open(tmp_path, "wb")
+		try:
+			f.write(body)
+		finally:
+			f.close()
+		size = os.path.getsize(tmp_path)
+		with self.lock:
+			if os.path.exists(path):
+				self.size -= os.path.getsize(path)
+			os.rename(tmp_path, path)
+			self.size += size
+			if self.size > self.max_bytes:
+				self._evict()
+
+	def _evict(self):
+		for path, mtime, size in sorted(self._entries(), key=lambda entry: entry[1]):
+			if self.size <= self.max_bytes:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				continue
+			self.size -= size
@@ -0,0 +1,144 @@
+"""
+Checkpoint stores remember, per feed, the cursor to resume from. The extractor
+records a cursor only once the page before it has been committed to the
+output, so resuming picks up exactly after the last durable commit. Use one
+store (or file) per API key.
+"""
+from collections import deque
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from graphite.load.writer import PendingCommit
+
+
+class AbstractCheckpointStore(object):
+
+	def get(self, feed):
+		"""
+		Returns the stored checkpoint for the feed, or None.
+		"""
+		raise Exception("unimplemented")
+
+	def set(self, feed, checkpoint):
+		raise Exception("unimplemented")
+
+	def clear(self, feed):
+		raise Exception("unimplemented")
+
+
+class CommitTracker(object):
+	"""
+	Follows what output.commit() returned for each page of a feed and tells
+	which cursor may be recorded. False holds the cursor until a later
+	commit covers it, a PendingCommit until it is done().
+	"""
+	def __init__(self):
+		self.pending = deque()
+		self.uncommitted = None
+
+	def page(self, committed, next):
+		"""
+		Returns the cursor to record after the page before next, or None.
+		"""
+		if committed is False:
+			self.uncommitted = next
+		elif isinstance(committed, PendingCommit):
+			self.pending.append((committed, next))
+			self.uncommitted = None
+		else:
+			# Everything up to this page is committed
+			self.pending.clear()
+			self.uncommitted = None
+			return next
+		cursor = None
+		while self.pending and self.pending[0][0].done():
+			cursor = self.pending.popleft()[1]
+		return cursor
+
+	def completed(self):
+		"""
+		Returns the cursor to record once output.complete() has committed
+		the rest, or None.
+		"""
+		if self.uncommitted:
+			return self.uncommitted
+		if self.pending:
+			return self.pending[-1][1]
+		return None
+
+
+class FileCheckpointStore(AbstractCheckpointStore):
+	"""
+	Keeps all feed checkpoints in a small JSON file that is rewritten
+	atomically on every update.
+	"""
+	filename = None
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.lock = threading.Lock()
+		self.checkpoints = {}
+		if os.path.exists(self.filename):
+			with open(self.filename) as f:
+				self.checkpoints = json.load(f)
+
+	def get(self, feed):
+		with self.lock:
+			return self.checkpoints.get(feed)
+
+	def set(self, feed, checkpoint):
+		with self.lock:
+			self.checkpoints[feed] = checkpoint
+			self._save()
+
+	def clear(self, feed):
+		with self.lock:
+			if self.checkpoints.pop(feed, None) is not None:
+				self._save()
+
+	def _save(self):
+		tmp_filename = self.filename + ".tmp"
+		with open(tmp_filename, "w") as f:
+			json.dump(self.checkpoints, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.rename(tmp_filename, self.filename)
+
+
+class SqliteCheckpointStore(AbstractCheckpointStore):
+	filename = None
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.lock = threading.Lock()
+		# Feeds may be loaded on several threads, access is serialized by the lock
+		self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+		self.conn.execute(
+			"CREATE TABLE IF NOT EXISTS `checkpoint` ("
+			"  `feed` varchar(32) NOT NULL,"
+			"  `checkpoint` varchar(128) NOT NULL,"
+			"  `ts` TIMESTAMP,"
+			"  PRIMARY KEY (`feed`) ON CONFLICT REPLACE"
+			")")
+		self.conn.commit()
+
+	def get(self, feed):
+		with self.lock:
+			row = self.conn.execute("SELECT checkpoint FROM checkpoint WHERE feed = ?", (feed,)).fetchone()
+		return row[0] if row else None
+
+	def set(self, feed, checkpoint):
+		with self.lock:
+			self.conn.execute("INSERT INTO checkpoint VALUES (?, ?, ?)", (feed, checkpoint, time.time()))
+			self.conn.commit()
+
+	def clear(self, feed):
+		with self.lock:
+			self.conn.execute("DELETE FROM checkpoint WHERE feed = ?", (feed,))
+			self.conn.commit()
+
+	def close(self):
+		self.conn.close()
@@ -0,0 +1,75 @@
+"""
+PagePrefetcher runs a page iterator on a background thread and keeps a bounded
+queue of decoded pages ahead of the consumer, so the network fetch of the next
+page overlaps the transform and load of the current one.
+"""
+import Queue
+import sys
+import threading
+
+
+_DONE = object()
+
+
+class PagePrefetcher(object):
+	pages = None
+	depth = None
+	# Seconds close() waits for the fetcher, which may be in the middle of a
+	# request and its retries; it is a daemon thread and exits at its next page
+	join_timeout = 1.0
+
+	def __init__(self, pages, depth=1):
+		self.pages = pages
+		self.depth = max(1, depth)
+		self.queue = Queue.Queue(maxsize=self.depth)
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self._fetch, name="graphite-prefetch")
+		self.thread.daemon = True
+
+	def __iter__(self):
+		self.thread.start()
+		try:
+			while True:
+				item = self.queue.get()
+				if item is _DONE:
+					return
+				ok, value = item
+				if not ok:
+					raise value[0], value[1], value[2]
+				yield value
+		finally:
+			self.close()
+
+	def _put(self, item):
+		# Poll so the fetcher notices when the consumer has gone away
+		while not self.stopped.is_set():
+			try:
+				self.queue.put(item, timeout=0.5)
+				return True
+			except Queue.Full:
+				pass
+		return False
+
+	def _fetch(self):
+		try:
+			for page in self.pages:
+				if not self._put((True, page)):
+					return
+		except Exception:
+			print >> sys.stderr, "prefetch failed", sys.exc_info()[1]
+			self._put((False, sys.exc_info()))
+			return
+		self._put(_DONE)
+
+	def close(self):
+		if self.stopped.is_set():
+			return
+		self.stopped.set()
+		# Drain anything queued so a blocked fetcher can exit
+		try:
+			while True:
+				self.queue.get_nowait()
+		except Queue.Empty:
+			pass
+		if self.thread.is_alive() and self.thread is not threading.current_thread():
+			self.thread.join(self.join_timeout)
@@ -0,0 +1,61 @@
+"""
+RetryPolicy decides how the extractors retry a page request: which responses
+are worth another attempt, how many attempts to make and how long to back off
+in between, using exponential backoff with jitter and honoring Retry-After.
+"""
+import random
+
+
+class PageFetchError(Exception):
+	pass
+
+
+class RetryPolicy(object):
+	max_attempts = 10
+	base_delay = 1.0
+	max_delay = 60.0
+	# Fraction of each delay that is randomized, spreads out retries from parallel feeds
+	jitter = 0.5
+	# Longest Retry-After we are willing to honor
+	max_retry_after = 300.0
+	retry_statuses = frozenset([429, 500, 502, 503, 504])
+	# Per attempt timeout in seconds, None uses the extractor's request_timeout
+	timeout = None
+
+	def __init__(self, max_attempts=None, base_delay=None, max_delay=None, jitter=None,
+			retry_statuses=None, timeout=None):
+		if max_attempts is not None:
+			self.max_attempts = max_attempts
+		if base_delay is not None:
+			self.base_delay = base_delay
+		if max_delay is not None:
+			self.max_delay = max_delay
+		if jitter is not None:
+			self.jitter = jitter
+		if retry_statuses is not None:
+			self.retry_statuses = frozenset(retry_statuses)
+		if timeout is not None:
+			self.timeout = timeout
+
+	def should_retry(self, attempt):
+		return attempt < self.max_attempts
+
+	def retry_status(self, status_code):
+		return status_code in self.retry_statuses
+
+	def backoff(self, attempt, retry_after=None):
+		"""
+		Seconds to wait after the given (1 based) attempt failed.
+		"""
+		if retry_after is not None:
+			return min(retry_after, self.max_retry_after)
+		delay = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+		return delay * (1 - self.jitter * random.random())
+
+	@staticmethod
+	def parse_retry_after(value):
+		# Only the delta-seconds form is supported, dates are ignored
+		try:
+			return max(0.0, float(value))
+		except (TypeError, ValueError):
+			return None
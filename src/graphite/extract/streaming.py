@@ -0,0 +1,79 @@
+"""
+StreamedPage incrementally decodes a feed page from an HTTP response, yielding
+the records of the feed's array as the bytes arrive instead of building the
+whole page in memory. Needs ijson, extraction falls back on response.json()
+when it is not installed.
+"""
+from graphite.extract.retry import PageFetchError
+
+try:
+	import ijson
+	from ijson.common import ObjectBuilder
+except ImportError:
+	ijson = None
+
+_CONTAINER_START = ("start_map", "start_array")
+_CONTAINER_END = ("end_map", "end_array")
+_SCALARS = ("null", "boolean", "integer", "double", "number", "string")
+
+
+class _ResponseReader(object):
+	"""
+	File-like read() over response.iter_content(), which takes care of any
+	gzip content encoding.
+	"""
+	def __init__(self, response, chunk_size):
+		self.chunks = response.iter_content(chunk_size)
+		self.buffer = ""
+
+	def read(self, size=-1):
+		while size < 0 or len(self.buffer) < size:
+			try:
+				self.buffer += next(self.chunks)
+			except StopIteration:
+				break
+		if size < 0:
+			data, self.buffer = self.buffer, ""
+		else:
+			data, self.buffer = self.buffer[:size], self.buffer[size:]
+		return data
+
+
+class StreamedPage(object):
+	"""
+	Iterate to get the page records, status and next are set once the page
+	has been read through.
+	"""
+	status = None
+	next = None
+
+	def __init__(self, response, key, chunk_size=64 * 1024):
+		self.response = response
+		self.key = key
+		self.chunk_size = chunk_size
+
+	def __iter__(self):
+		item_prefix = self.key + ".item"
+		builder = None
+		events = ijson.parse(_ResponseReader(self.response, self.chunk_size))
+		try:
+			for prefix, event, value in events:
+				if builder is not None:
+					builder.event(event, value)
+					if prefix == item_prefix and event in _CONTAINER_END:
+						yield builder.value
+						builder = None
+				elif prefix == item_prefix and self.status in (None, "OK"):
+					if event in _CONTAINER_START:
+						builder = ObjectBuilder()
+						builder.event(event, value)
+					elif event in _SCALARS:
+						yield value
+				elif prefix == "status" and event in _SCALARS:
+					self.status = value
+				elif prefix == "next" and event in _SCALARS:
+					self.next = value
+		finally:
+			self.response.close()
+		if self.status != "OK":
+			raise PageFetchError("unexpected status %r in streamed %s page" % (self.status, self.key))
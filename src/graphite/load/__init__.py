@@ -1 +1 @@
-from graphite.load.base import AbstractOutputFormat, MultipleOutputFormat, TransformedOutput
+from graphite.load.base import AbstractOutputFormat, MultipleOutputFormat, TransformedOutput, SynchronizedOutput, output_handle_batch, output_handle_columns
@@ -1,6 +1,25 @@
+import itertools
+import threading
+
+from graphite.load.writer import PendingCommit
+from graphite.transform import handle_batch, flatten_results
+
+
+# Rows handed to each output at a time when a batch is fanned out
+CHUNK_SIZE = 1000
 
 
 class AbstractOutputFormat(object):
+	# Outputs that buffer rows until commit() flush early once this many are
+	# buffered, None buffers the whole page
+	max_buffered_rows = None
+
+	# commit() is called after every page. Outputs that group several pages
+	# into one transaction return False while the page is not yet durable,
+	# and must commit whatever is left in complete(). Outputs committing on
+	# a writer thread return a graphite.load.writer.PendingCommit. complete()
+	# returns False when it leaves the feed's rows uncommitted, e.g. in an
+	# output other feeds keep open, so the feed's last cursor is not kept.
 
 	def start(self, node_type):
 		raise Exception("unimplemented")
@@ -10,6 +29,22 @@ class AbstractOutputFormat(object):
 		raise Exception("unimplemented")
 		pass
 
+	def handle_batch(self, node_type, items):
+		"""
+		Handles an iterable of (id, node) pairs, override to load a whole page
+		at once.
+		"""
+		handle = self.handle
+		for id, node in items:
+			handle(node_type, id, node)
+
+	def handle_columns(self, node_type, batch):
+		"""
+		Handles a graphite.transform.ColumnBatch, override to load the columns
+		without building a dict per row.
+		"""
+		self.handle_batch(node_type, batch.rows())
+
 	def complete(self):
 		raise Exception("unimplemented")
 		pass
@@ -34,9 +69,37 @@ class MultipleOutputFormat(object):
 		for output in self.outputs:
 			output.handle(node_type, id, node)
 
+	def handle_batch(self, node_type, items):
+		# Every output needs to see each item, go chunk by chunk so a big
+		# fan-out is never held in memory as a whole
+		for chunk in chunks(items, CHUNK_SIZE):
+			for output in self.outputs:
+				output_handle_batch(output, node_type, chunk)
+
+	def handle_columns(self, node_type, batch):
+		for output in self.outputs:
+			output_handle_columns(output, node_type, batch)
+
+	def commit(self):
+		# Only committed once every output has committed
+		committed = True
+		pending = []
+		for output in self.outputs:
+			result = output.commit()
+			if result is False:
+				committed = False
+			elif isinstance(result, PendingCommit):
+				pending.append(result)
+		if committed and pending:
+			return PendingCommit.join(pending)
+		return committed
+
 	def complete(self):
+		completed = True
 		for output in self.outputs:
-			output.complete()
+			if output.complete() is False:
+				completed = False
+		return completed
 
 
 class TransformedOutput(object):
@@ -52,8 +115,111 @@ class TransformedOutput(object):
 
 	def handle(self, node_type, id, node):
 		results = self.transform.handle(node_type, id, node)
-		for result in results:
+		for id, result in flatten_results([(id, results)]):
 			self.output.handle(node_type, id, result)
 
+	def handle_batch(self, node_type, items):
+		results = handle_batch(self.transform, node_type, items)
+		output_handle_batch(self.output, node_type, flatten_results(results))
+
+	def commit(self):
+		return self.output.commit()
+
+	def complete(self):
+		return self.output.complete()
+
+
+class SynchronizedOutput(object):
+	"""
+	Wraps an output so several feeds loading concurrently can share it. Calls
+	are serialized with a lock, the wrapped output is started by the first
+	feed and completed when the last feed completes.
+
+	The wrapped output is called from whichever feed thread holds the lock,
+	so it must not be tied to the thread that started it. The database
+	outputs are fine, connections that check their thread are not.
+	"""
+	output = None
+
+	def __init__(self, output=None):
+		self.output = output
+		self.lock = threading.RLock()
+		self.active = 0
+
+	def start(self, node_type):
+		with self.lock:
+			if self.active == 0:
+				self.output.start(node_type)
+			self.active += 1
+
+	def handle(self, node_type, id, node):
+		with self.lock:
+			self.output.handle(node_type, id, node)
+
+	def handle_batch(self, node_type, items):
+		# Transform outside the lock, the output only sees finished nodes
+		for chunk in chunks(items, CHUNK_SIZE):
+			with self.lock:
+				output_handle_batch(self.output, node_type, chunk)
+
+	def handle_columns(self, node_type, batch):
+		with self.lock:
+			output_handle_columns(self.output, node_type, batch)
+
+	def commit(self):
+		with self.lock:
+			return self.output.commit()
+
 	def complete(self):
-		self.output.complete()
+		with self.lock:
+			self.active -= 1
+			if self.active == 0:
+				return self.output.complete()
+			else:
+				# Other feeds keep the output open, make sure everything this
+				# feed handed over is committed before its checkpoint is kept
+				commit_transaction = getattr(self.output, "commit_transaction", None)
+				if commit_transaction is None:
+					# The rows stay uncommitted until the last feed completes
+					return False
+				commit_transaction()
+
+
+def output_handle_batch(output, node_type, items):
+	"""
+	Passes (id, node) pairs to output.handle_batch, falling back on handle for
+	outputs that don't derive from AbstractOutputFormat.
+	"""
+	batch = getattr(output, "handle_batch", None)
+	if batch is not None:
+		batch(node_type, items)
+	else:
+		handle = output.handle
+		for id, node in items:
+			handle(node_type, id, node)
+
+
+def output_handle_columns(output, node_type, batch):
+	batch_columns = getattr(output, "handle_columns", None)
+	if batch_columns is not None:
+		batch_columns(node_type, batch)
+	else:
+		output_handle_batch(output, node_type, batch.rows())
+
+
+def price(text):
+	if text is None:
+		return None
+	price = text[1:] if text.startswith("$") else text
+	if not price:
+		return "0.00"
+	return price
+
+
+def chunks(items, size):
+	items = iter(items)
+	while True:
+		chunk = list(itertools.islice(items, size))
+		if not chunk:
+			return
+		yield chunk
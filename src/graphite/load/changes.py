@@ -0,0 +1,118 @@
+"""
+ChangeStore keeps a content hash per row key in a local SQLite file, so
+outputs can tell on incremental runs which rows are new, which changed and
+which are identical to what was last written, and skip the identical ones.
+Hashes of a page only become durable when the output commits it. Hashes are
+kept per database, so outputs writing to different databases can share a
+store.
+"""
+from collections import OrderedDict
+import hashlib
+import sqlite3
+import struct
+import threading
+
+
+# Keys looked up per SELECT, below SQLite's bound parameter limit
+LOOKUP_CHUNK = 500
+
+
+def row_hash(row):
+	return struct.unpack("<q", hashlib.md5(repr(row)).digest()[:8])[0]
+
+
+class ChangeStore(object):
+	"""
+	One store may be shared by several outputs, each output works through a
+	session() of its own.
+	"""
+	filename = None
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.lock = threading.Lock()
+		self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+		self.conn.execute(
+			"CREATE TABLE IF NOT EXISTS `row_hash` ("
+			"  `tbl` varchar(255) NOT NULL,"
+			"  `key` varchar(128) NOT NULL,"
+			"  `hash` INTEGER NOT NULL,"
+			"  PRIMARY KEY (`tbl`, `key`)"
+			")")
+		self.conn.commit()
+
+	def session(self, database):
+		"""
+		Returns a ChangeSession for an output writing to database, a name
+		that tells apart the databases whose hashes are kept in this store.
+		"""
+		return ChangeSession(self, database)
+
+	def lookup(self, tbl, keys):
+		stored = {}
+		with self.lock:
+			for i in range(0, len(keys), LOOKUP_CHUNK):
+				chunk = keys[i:i + LOOKUP_CHUNK]
+				query = "SELECT `key`, `hash` FROM row_hash WHERE tbl = ? AND `key` IN (%s)" % ", ".join("?" * len(chunk))
+				stored.update(self.conn.execute(query, [tbl] + chunk))
+		return stored
+
+	def record(self, hashes):
+		"""
+		Stores the hashes of a {(tbl, key): hash} dict.
+		"""
+		with self.lock:
+			self.conn.executemany("INSERT OR REPLACE INTO row_hash VALUES (?, ?, ?)",
+				[(tbl, key, hash) for (tbl, key), hash in hashes.iteritems()])
+			self.conn.commit()
+
+	def close(self):
+		self.conn.close()
+
+
+class ChangeSession(object):
+	"""
+	The hashes of one output's rows. Hashes classified since the last
+	commit() are pending, so they only count for the rows of this output
+	until it commits them.
+	"""
+	def __init__(self, store, database):
+		self.store = store
+		self.database = database
+		self.pending = {}
+
+	def classify(self, table, rows, key_index=0):
+		"""
+		Splits rows into (new, changed) lists, dropping rows whose content is
+		unchanged. The row key is row[key_index], of rows with the same key
+		only the last is kept as a REPLACE would.
+		"""
+		tbl = "%s/%s" % (self.database, table)
+		latest = OrderedDict()
+		for row in rows:
+			latest[unicode(row[key_index])] = row
+		keyed = [(key, row_hash(row), row) for key, row in latest.iteritems()]
+		stored = self.store.lookup(tbl, [key for key, hash, row in keyed])
+		new, changed = [], []
+		for key, hash, row in keyed:
+			previous = self.pending.get((tbl, key), stored.get(key))
+			if previous == hash:
+				continue
+			if previous is None:
+				new.append(row)
+			else:
+				changed.append(row)
+			self.pending[(tbl, key)] = hash
+		return new, changed
+
+	def commit(self):
+		"""
+		Records the hashes classified since the last commit, call once the
+		rows themselves are committed.
+		"""
+		if self.pending:
+			self.store.record(self.pending)
+		self.pending = {}
+
+	def rollback(self):
+		self.pending = {}
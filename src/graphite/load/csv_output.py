@@ -1,24 +1,64 @@
 from graphite.load import AbstractOutputFormat
+from graphite.load.schema import TableOutput
+from graphite.transform.dates import format_sql
 
 try:
 	import unicodecsv as csv
 except ImportError:
 	import csv
 
+# The utf-8 fast path encodes values itself, so the plain writer will do
+import csv as plain_csv
 import codecs
 import cStringIO
+import datetime
+import os
 import sys
 
 
+def column_keys(columns):
+	"""
+	Node keys of the columns for utf8_row(), None for the id column.
+	"""
+	return [None if heading == "id" else unicode(heading, "UTF-8").encode("utf-8") for heading in columns]
+
+
+def utf8_row(keys, id, node):
+	"""
+	Row of node's values for keys with unicode encoded to utf-8, the key
+	None stands for the id.
+	"""
+	row = []
+	for key in keys:
+		value = id if key is None else node.get(key, "")
+		row.append(value.encode("utf-8") if isinstance(value, unicode) else value)
+	return row
+
+
 class CSVOutput(AbstractOutputFormat):
-	def __init__(self, f, columns, auto_flush=True, dialect=csv.excel, encoding="utf-8", **kwds):
-		# Redirect output to a queue
-		self.queue = cStringIO.StringIO()
-		self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
+	"""
+	Writes one row per node with the given columns. With the default utf-8
+	encoding rows are encoded once and collected in a write buffer of
+	buffer_size bytes, which goes to f a page at a time.
+	"""
+	buffer_size = 1024 * 1024
+
+	def __init__(self, f, columns, auto_flush=True, dialect=csv.excel, encoding="utf-8", buffer_size=None, **kwds):
 		self.stream = f
 		self.auto_flush = auto_flush
 		self.columns = columns
-		self.encoder = codecs.getincrementalencoder(encoding)()
+		if buffer_size:
+			self.buffer_size = buffer_size
+		self.fast = codecs.lookup(encoding).name == "utf-8"
+		if self.fast:
+			self.keys = column_keys(columns)
+			self.buffer = cStringIO.StringIO()
+			self.writer = plain_csv.writer(self.buffer, dialect=dialect, **kwds)
+		else:
+			# Redirect output to a queue
+			self.queue = cStringIO.StringIO()
+			self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
+			self.encoder = codecs.getincrementalencoder(encoding)()
 
 	def start(self, node_type):
 		self.write_row(self.columns)
@@ -35,11 +75,78 @@ class CSVOutput(AbstractOutputFormat):
 					row.append(row_data.get(unicode(heading, "UTF-8").encode("utf-8"), u""))
 		return row
 
+	def _utf8_row(self, id, node):
+		return utf8_row(self.keys, id, node)
+
 	def handle(self, node_type, id, node):
+		if self.fast:
+			self.write_rows([self._utf8_row(id, node)])
+			return
 		formatted = self._format_row(id, node)
 		self.write_row(formatted)
 
+	def handle_batch(self, node_type, items):
+		if not self.fast:
+			return AbstractOutputFormat.handle_batch(self, node_type, items)
+		utf8_row = self._utf8_row
+		self.write_rows([utf8_row(id, node) for id, node in items])
+
+	def handle_columns(self, node_type, batch):
+		if self.fast:
+			columns = []
+			for key in self.keys:
+				values = batch.ids if key is None else batch.column(key)
+				if values is None:
+					columns.append([""] * len(batch))
+				else:
+					columns.append([value.encode("utf-8") if isinstance(value, unicode) else value for value in values])
+			self.write_rows(zip(*columns))
+			return
+		columns = []
+		for heading in self.columns:
+			if heading == "id":
+				columns.append(batch.ids)
+			else:
+				values = batch.column(unicode(heading, "UTF-8").encode("utf-8"))
+				columns.append([self._format_value(value) for value in values] if values is not None else [u""] * len(batch))
+		for row in zip(*columns):
+			self.write_row(row)
+
+	@staticmethod
+	def _format_value(value):
+		try:
+			return unicode(value, "UTF-8")
+		except:
+			return value
+
+	def write_rows(self, rows):
+		"""
+		Writes utf-8 encoded rows to the write buffer.
+		"""
+		position = self.buffer.tell()
+		try:
+			self.writer.writerows(rows)
+		except Exception:
+			# Drop the partly written page and skip just the row that fails
+			self.buffer.seek(position)
+			self.buffer.truncate()
+			for row in rows:
+				try:
+					self.writer.writerow(row)
+				except Exception as e:
+					print >> sys.stderr, "failed to write row", row, e
+		if self.buffer.tell() >= self.buffer_size:
+			self.flush_buffer()
+
+	def flush_buffer(self):
+		self.stream.write(self.buffer.getvalue())
+		self.buffer.seek(0)
+		self.buffer.truncate()
+
 	def write_row(self, row):
+		if self.fast:
+			self.write_rows([[value.encode("utf-8") if isinstance(value, unicode) else value for value in row]])
+			return
 		try:
 			self.writer.writerow(row)
 			# Fetch UTF-8 output from the queue ...
@@ -55,10 +162,72 @@ class CSVOutput(AbstractOutputFormat):
 			print >> sys.stderr, "failed to write row", row, e
 
 	def commit(self):
+		if self.fast:
+			self.flush_buffer()
 		if self.auto_flush:
 			self.stream.flush()
 
 	def complete(self):
+		if self.fast:
+			self.flush_buffer()
 		if self.auto_flush:
 			self.stream.flush()
 			self.stream.close()
+
+
+def _table_value(value):
+	if value is None:
+		return ""
+	if value is True or value is False:
+		return "1" if value else "0"
+	if isinstance(value, unicode):
+		return value.encode("utf-8")
+	if isinstance(value, datetime.datetime):
+		# strftime() refuses years before 1900
+		return format_sql(value)
+	return value
+
+
+class TableCSVOutput(TableOutput):
+	"""
+	Writes the rows MySQLOutput and SqliteOutput would load as one UTF-8 CSV
+	file per table in directory, with the columns of graphite.load.schema.
+	Rows are written at commit().
+	"""
+	directory = None
+
+	def __init__(self, directory, max_buffered_rows=None, dedup=None, dialect=csv.excel):
+		TableOutput.__init__(self, max_buffered_rows, dedup)
+		self.directory = directory
+		self.dialect = dialect
+		self.files = {}
+
+	def start(self, node_type):
+		self.reset()
+
+	def writer(self, table):
+		if table.name not in self.files:
+			f = open(os.path.join(self.directory, table.name + ".csv"), "ab")
+			writer = csv.writer(f, dialect=self.dialect)
+			if f.tell() == 0:
+				writer.writerow(table.column_names)
+			self.files[table.name] = (f, writer)
+		return self.files[table.name][1]
+
+	def flush(self):
+		buffers = self.take_buffers()
+		for insert in self.inserts:
+			rows = buffers[insert.buffer]
+			if rows:
+				self.writer(insert.table).writerows([[_table_value(value) for value in row] for row in rows])
+
+	def commit(self):
+		self.flush()
+		for f, writer in self.files.values():
+			f.flush()
+
+	def complete(self):
+		self.commit()
+		for f, writer in self.files.values():
+			f.close()
+		self.files = {}
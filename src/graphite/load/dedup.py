@@ -0,0 +1,96 @@
+"""
+Dedup indexes remember the rows an output has already sent during a run, so
+duplicates the database would ignore (friend edges and friend profiles
+repeated across pages and feeds) can be dropped before they reach it. Pass
+one to an output's dedup argument and give every output its own index, an
+index shared with a second output would make it drop the rows the first one
+already sent.
+"""
+import array
+
+
+class HashDedupIndex(object):
+	"""
+	Remembers row keys by their hash in an open addressing table taking
+	max_bytes up front. Keys are only compared by hash, so a key colliding
+	with one seen before is dropped although it is new; use it for rows the
+	database would ignore anyway. Once the table is max_load full
+	new keys are no longer recorded and are passed through to the database.
+	"""
+	max_load = 0.5
+	max_bytes = None
+
+	def __init__(self, max_bytes=64 * 1024 * 1024):
+		self.max_bytes = max_bytes
+		# hash() returns a C long, the same as the array's items
+		itemsize = array.array("l").itemsize
+		size = 1
+		while size * 2 * itemsize <= max_bytes:
+			size *= 2
+		self.mask = size - 1
+		self.slots = array.array("l", [0]) * size
+		self.max_entries = int(size * self.max_load)
+		self.count = 0
+
+	def seen(self, key):
+		"""
+		Returns True if key was seen before, otherwise records it.
+		"""
+		# 0 marks an empty slot
+		h = hash(key) or 1
+		slots, mask = self.slots, self.mask
+		i = (h ^ (h >> 17)) & mask
+		while True:
+			stored = slots[i]
+			if stored == h:
+				return True
+			if not stored:
+				break
+			i = (i + 1) & mask
+		if self.count < self.max_entries:
+			slots[i] = h
+			self.count += 1
+		return False
+
+	def __len__(self):
+		return self.count
+
+
+class BloomDedupIndex(object):
+	"""
+	Bloom filter over row keys using max_bytes of memory. It never runs out
+	of room, but with probability false_positive_rate() a row that was not
+	seen before is reported as seen and dropped, so only use it for rows the
+	database would ignore anyway (e.g. INSERT IGNORE friend edges).
+	"""
+	hashes = 4
+	max_bytes = None
+
+	def __init__(self, max_bytes=16 * 1024 * 1024, hashes=None):
+		self.max_bytes = max_bytes
+		if hashes:
+			self.hashes = hashes
+		self.size = max_bytes * 8
+		self.bits = array.array("B", [0]) * max_bytes
+		self.count = 0
+
+	def seen(self, key):
+		h1 = hash(key)
+		h2 = hash((key, 0x9e3779b9)) | 1
+		bits = self.bits
+		found = True
+		for i in range(self.hashes):
+			bit = (h1 + i * h2) % self.size
+			byte, mask = bit >> 3, 1 << (bit & 7)
+			if not bits[byte] & mask:
+				found = False
+				bits[byte] |= mask
+		if not found:
+			self.count += 1
+		return found
+
+	def false_positive_rate(self):
+		return (1 - (1 - 1.0 / self.size) ** (self.hashes * self.count)) ** self.hashes
+
+	def __len__(self):
+		return self.count
@@ -0,0 +1,237 @@
+"""
+PartitionedFileOutput writes CSV parts that downstream jobs can read in
+parallel. Rows are split into partition directories by node type and/or a
+date field (Hive style, e.g. node_type=action/created=2014-01-01), each
+partition rotates into numbered parts by row count or size, and finished
+parts are compressed on a background thread. manifest.json lists every part
+with its row count when the output completes, a later run into the same
+directory adds its parts to those already there. zstd compression requires
+the zstandard module.
+"""
+import gzip
+import json
+import os
+import shutil
+import csv
+from collections import OrderedDict
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+from graphite.load import AbstractOutputFormat
+from graphite.load.csv_output import column_keys, utf8_row
+from graphite.load.writer import BackgroundWriter
+from graphite.transform.dates import DateParser
+
+
+NODE_TYPE = "node_type"
+
+EXTENSIONS = {
+	None: "",
+	"gzip": ".gz",
+	"zstd": ".zst",
+}
+
+
+def compress_part(path, compression, level=None):
+	"""
+	Compresses the file at path next to it and removes the original, returns
+	the compressed file's path.
+	"""
+	target = path + EXTENSIONS[compression]
+	with open(path, "rb") as src:
+		if compression == "gzip":
+			dst = gzip.open(target, "wb", level or 6)
+			try:
+				shutil.copyfileobj(src, dst, 1024 * 1024)
+			finally:
+				dst.close()
+		else:
+			with open(target, "wb") as dst:
+				zstandard.ZstdCompressor(level=level or 3).copy_stream(src, dst)
+	os.remove(path)
+	return target
+
+
+class Part(object):
+	def __init__(self, path, partition, buffer_size):
+		self.path = path
+		self.partition = partition
+		self.rows = 0
+		self.file = open(path, "wb", buffer_size)
+		self.writer = csv.writer(self.file)
+
+	def size(self):
+		return self.file.tell()
+
+
+class PartitionedFileOutput(AbstractOutputFormat):
+	"""
+	columns is a list of node keys as for CSVOutput, or a dict of node type
+	to such a list. partition_by is NODE_TYPE, the name of a date field, or
+	a sequence of those. A part is closed once it has rotate_rows rows or
+	rotate_bytes bytes (uncompressed), compression is None, "gzip" or
+	"zstd". At most max_open_parts parts are open at once, the least recently
+	written one is closed to open another. commit() returns False as parts
+	only reach manifest.json once complete() has closed them.
+	"""
+	directory = None
+	partition_by = ()
+	rotate_rows = None
+	rotate_bytes = None
+	compression = None
+	compression_level = None
+	buffer_size = 1024 * 1024
+	max_open_parts = 64
+
+	def __init__(self, directory, columns, partition_by=None, rotate_rows=None, rotate_bytes=None,
+			compression=None, compression_level=None, max_pending_parts=None, buffer_size=None,
+			max_open_parts=None):
+		if compression not in EXTENSIONS:
+			raise ValueError("unknown compression %r" % (compression,))
+		if compression == "zstd" and zstandard is None:
+			raise ImportError("zstd compression requires the zstandard module")
+		self.directory = directory
+		self.columns = columns
+		if partition_by:
+			self.partition_by = (partition_by,) if isinstance(partition_by, basestring) else tuple(partition_by)
+		if isinstance(columns, dict) and NODE_TYPE not in self.partition_by:
+			raise ValueError("columns per node type need partition_by to include %r" % NODE_TYPE)
+		self.rotate_rows = rotate_rows
+		self.rotate_bytes = rotate_bytes
+		self.compression = compression
+		self.compression_level = compression_level
+		self.max_pending_parts = max_pending_parts
+		if buffer_size:
+			self.buffer_size = buffer_size
+		if max_open_parts:
+			self.max_open_parts = max_open_parts
+		self.date_parser = DateParser()
+		self.keys = {}
+		# Least recently written first
+		self.open_parts = OrderedDict()
+		self.part_numbers = {}
+		# Manifest entries of the parts closed so far, including those of
+		# earlier runs into the directory
+		self.parts = []
+		manifest = os.path.join(self.directory, "manifest.json")
+		if os.path.exists(manifest):
+			with open(manifest, "rb") as f:
+				self.parts = json.load(f)["parts"]
+		self.compressor = None
+
+	def start(self, node_type):
+		if self.compression is not None and self.compressor is None:
+			self.compressor = BackgroundWriter(self._compress, self.max_pending_parts, "graphite-compressor")
+
+	def _columns(self, node_type):
+		if isinstance(self.columns, dict):
+			return self.columns[node_type]
+		return self.columns
+
+	def _keys(self, node_type):
+		keys = self.keys.get(node_type)
+		if keys is None:
+			keys = self.keys[node_type] = column_keys(self._columns(node_type))
+		return keys
+
+	def _partition(self, node_type, node):
+		partition = []
+		for field in self.partition_by:
+			if field == NODE_TYPE:
+				partition.append((field, node_type))
+			else:
+				partition.append((field, self._date_value(field, node.get(field))))
+		return tuple(partition)
+
+	def _date_value(self, field, value):
+		# SQL formatted dates, e.g. after SQLDateFormatTransform, start with the day
+		if isinstance(value, basestring) and len(value) >= 10 and value[4:5] == "-":
+			return value[:10]
+		dte = self.date_parser.parse_or_none(value, field)
+		if dte is None:
+			return "unknown"
+		return "%04d-%02d-%02d" % (dte.year, dte.month, dte.day)
+
+	def _part(self, node_type, partition):
+		part = self.open_parts.pop(partition, None)
+		if part is None:
+			if len(self.open_parts) >= self.max_open_parts:
+				self._close_part(self.open_parts.itervalues().next())
+			directory = os.path.join(self.directory, *["%s=%s" % pair for pair in partition])
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+			# Parts of earlier runs into the directory are kept, compressed or not
+			number = self.part_numbers.get(partition, 0)
+			while any(os.path.exists(os.path.join(directory, "part-%05d.csv%s" % (number, extension)))
+					for extension in EXTENSIONS.values()):
+				number += 1
+			self.part_numbers[partition] = number + 1
+			part = Part(os.path.join(directory, "part-%05d.csv" % number), partition, self.buffer_size)
+			part.writer.writerow(self._columns(node_type))
+		self.open_parts[partition] = part
+		return part
+
+	def handle(self, node_type, id, node):
+		self.handle_batch(node_type, [(id, node)])
+
+	def handle_batch(self, node_type, items):
+		keys = self._keys(node_type)
+		if not self.partition_by:
+			partition = ()
+		elif self.partition_by == (NODE_TYPE,):
+			partition = ((NODE_TYPE, node_type),)
+		else:
+			partition = None
+		for id, node in items:
+			part = self._part(node_type, partition if partition is not None else self._partition(node_type, node))
+			part.writer.writerow(utf8_row(keys, id, node))
+			part.rows += 1
+			if ((self.rotate_rows and part.rows >= self.rotate_rows)
+					or (self.rotate_bytes and part.size() >= self.rotate_bytes)):
+				self._close_part(part)
+
+	def _close_part(self, part):
+		del self.open_parts[part.partition]
+		part.file.close()
+		entry = {
+			"path": os.path.relpath(part.path, self.directory),
+			"partition": dict(part.partition),
+			"rows": part.rows,
+		}
+		self.parts.append(entry)
+		if self.compressor is not None:
+			self.compressor.submit(entry)
+
+	def _compress(self, entry):
+		path = compress_part(os.path.join(self.directory, entry["path"]), self.compression, self.compression_level)
+		entry["path"] = os.path.relpath(path, self.directory)
+
+	def commit(self):
+		for part in self.open_parts.values():
+			part.file.flush()
+		return False
+
+	def complete(self):
+		for part in self.open_parts.values():
+			self._close_part(part)
+		if self.compressor is not None:
+			compressor, self.compressor = self.compressor, None
+			compressor.close()
+		self.write_manifest()
+
+	def write_manifest(self):
+		for entry in self.parts:
+			entry["bytes"] = os.path.getsize(os.path.join(self.directory, entry["path"]))
+		manifest = {
+			"compression": self.compression,
+			"partition_by": list(self.partition_by),
+			"parts": self.parts,
+			"rows": sum(entry["rows"] for entry in self.parts),
+		}
+		path = os.path.join(self.directory, "manifest.json")
+		with open(path + ".tmp", "wb") as f:
+			json.dump(manifest, f, indent=2, sort_keys=True)
+		os.rename(path + ".tmp", path)
@@ -1,406 +1,248 @@
+import os
 import sys
-from datetime import datetime
+import tempfile
+import time
+from datetime import date, datetime
 from warnings import filterwarnings
 
 import MySQLdb
 
-from graphite.load import AbstractOutputFormat
-from graphite import (NODE_TYPE_USER, NODE_TYPE_FRIEND, NODE_TYPE_OBJECT,
-	NODE_TYPE_ACTION, NODE_TYPE_SALE, NODE_TYPE_USER_BOARD, NODE_TYPE_BRAND_BOARD,
-	NODE_TYPE_FOLLOW, NODE_TYPE_USER_LIKE, NODE_TYPE_LIKE)
-
-
-# TODO: create a meta schema object that can be shared by all outputs
-TABLES = []
-TABLES.append(('profile',
-	"CREATE TABLE IF NOT EXISTS `profile` ("
-	"  `facebook_id` BIGINT UNSIGNED NOT NULL,"
-	"  `is_user` bit,"
-	"  `user_id` CHAR(24) NULL,"
-	"  `name` varchar(128),"
-	"  `username` varchar(128),"
-	"  `first_name` varchar(128),"
-	"  `last_name` varchar(128),"
-	"  `profile_image` varchar(512),"
-	"  `hometown` varchar(128),"
-	"  `location` varchar(128),"
-	"  `email` varchar(128),"
-	"  `gender` varchar(10),"
-	"  `birthday` date,"
-	"  `ts` TIMESTAMP,"
-	"  PRIMARY KEY (`facebook_id`),"
-	"  INDEX (`user_id`)"
-	")")
-)
-TABLES.append(('friend',
-	"CREATE TABLE IF NOT EXISTS `friend` ("
-	"  `facebook_id` BIGINT UNSIGNED NOT NULL,"
-	"  `friend_id` BIGINT UNSIGNED NOT NULL,"
-	"  PRIMARY KEY (`facebook_id`, `friend_id`)"
-	")")
-)
-
-TABLES.append(('object',
-	"CREATE TABLE IF NOT EXISTS `object` ("
-	"  `id` CHAR(24) NOT NULL,"
-	"  `url` varchar(512),"
-	"  `image` varchar(512),"
-	"  `title` varchar(512),"
-	"  `description` varchar(512),"
-	"  `price` varchar(20),"
-	"  `ts` TIMESTAMP,"
-	"  `created` TIMESTAMP,"
-	"  PRIMARY KEY (`id`)"
-	")")
-)
-
-TABLES.append(('object_tag',
-	"CREATE TABLE IF NOT EXISTS `object_tag` ("
-	"  `object_id` CHAR(24) NOT NULL,"
-	"  `tag` varchar(512) NOT NULL,"
-	"  `is_user_tag` BIT NOT NULL,"
-	"  PRIMARY KEY (`object_id`, `tag`)"
-	")")
-)
-
-TABLES.append(('action',
-	"CREATE TABLE IF NOT EXISTS `action` ("
-	"  `user_id` CHAR(24) NOT NULL,"
-	"  `object_id` CHAR(24) NOT NULL,"
-	"  `action` varchar(32) NOT NULL,"
-	"  `created` TIMESTAMP NOT NULL,"
-	"  `deleted` TIMESTAMP NULL,"
-	"  PRIMARY KEY (`user_id`, `object_id`, `action`)"
-	")")
-)
-
-TABLES.append(('sale',
-	"CREATE TABLE IF NOT EXISTS `sale` ("
-	"  `sale_id` CHAR(24) NOT NULL,"
-	"  `user_id` CHAR(24) NOT NULL,"
-	"  `order_number` VARCHAR(32),"
-	"  `total` decimal(9,2) NOT NULL,"
-	"  `ts` TIMESTAMP NOT NULL,"
-	"  PRIMARY KEY (`id`)"
-	")")
-)
-
-TABLES.append(('sale_object',
-	"CREATE TABLE IF NOT EXISTS `sale_object` ("
-	"  `sale_id` CHAR(24) NOT NULL,"
-	"  `object_id` CHAR(24) NOT NULL,"
-	"  `price` decimal(9,2) NOT NULL,"
-	"  `quantity` INT UNSIGNED NOT NULL,"
-	"  PRIMARY KEY (`sale_id`, `object_id`)"
-	")")
-)
-
-TABLES.append(('board',
-	"CREATE TABLE IF NOT EXISTS `board` ("
-	"  `id` CHAR(24) NOT NULL,"
-	"  `is_brand_board` BIT NOT NULL,"
-	"  `name` VARCHAR(128) NOT NULL,"
-	"  `user_id` CHAR(24) NULL,"
-	"  `created` TIMESTAMP NULL,"
-	"  `deleted` TIMESTAMP NULL,"
-	"  PRIMARY KEY (`id`)"
-	")")
-)
-TABLES.append(('board_object',
-	"CREATE TABLE IF NOT EXISTS `board_object` ("
-	"  `board_id` CHAR(24) NOT NULL,"
-	"  `object_id` CHAR(24) NOT NULL,"
-	"  PRIMARY KEY (`board_id`, `object_id`)"
-	")")
-)
-
-TABLES.append(('follow',
-	"CREATE TABLE IF NOT EXISTS `follow` ("
-	"  `user_id` CHAR(24) NOT NULL,"
-	"  `follower_id` CHAR(24) NOT NULL,"
-	"  `created` TIMESTAMP NOT NULL,"
-	"  `deleted` TIMESTAMP NULL,"
-	"  PRIMARY KEY (`user_id`, `follower_id`)"
-	")")
-)
-
-TABLES.append(('board_action',
-	"CREATE TABLE IF NOT EXISTS `board_action` ("
-	"  `board_id` CHAR(24) NOT NULL,"
-	"  `user_id` CHAR(24) NOT NULL,"
-	"  `object_id` CHAR(24) NULL,"
-	"  `action` varchar(32) NOT NULL,"
-	"  `created` TIMESTAMP NOT NULL,"
-	"  `deleted` TIMESTAMP NULL,"
-	"  PRIMARY KEY (`board_id`, `user_id`, `object_id`, `action`)"
-	")")
-)
-
-TABLES.append(('user_like',
-	"CREATE TABLE IF NOT EXISTS `user_like` ("
-	"  `facebook_id` BIGINT UNSIGNED NOT NULL,"
-	"  `like_id` BIGINT UNSIGNED NOT NULL,"
-	"  `category` varchar(32) NOT NULL,"
-	"  `name` varchar(512) NULL,"
-	"  `created` TIMESTAMP NULL,"
-	"  PRIMARY KEY (`facebook_id`, `like_id`)"
-	")")
-)
-
-TABLES.append(('like',
-	"CREATE TABLE IF NOT EXISTS `like` ("
-	"  `facebook_id` BIGINT UNSIGNED NOT NULL,"
-	"  `like_id` BIGINT UNSIGNED NOT NULL,"
-	"  `category` varchar(32) NOT NULL,"
-	"  `name` varchar(512) NULL,"
-	"  `created` TIMESTAMP NULL,"
-	"  PRIMARY KEY (`facebook_id`, `like_id`)"
-	")")
-)
+from graphite.load.schema import (DatabaseOutput, TABLES, NODE_TABLES, column_names, REPLACE,
+	IGNORE, BIGINT, INT, ID, VARCHAR, BOOL, DATE, TIMESTAMP, DECIMAL)
+from graphite.transform.dates import format_sql
+
+
+TYPES = {
+	BIGINT: "BIGINT UNSIGNED",
+	INT: "INT UNSIGNED",
+	ID: "CHAR(24)",
+	VARCHAR: "varchar(%d)",
+	BOOL: "BIT",
+	DATE: "date",
+	TIMESTAMP: "TIMESTAMP",
+	DECIMAL: "decimal(9,2)",
+}
+
+VERBS = {
+	REPLACE: "REPLACE",
+	IGNORE: "INSERT IGNORE",
+}
+
+def upsert_sql(table):
+	"""
+	INSERT updating the stored row in place when its key exists, unlike
+	REPLACE it doesn't delete and reinsert the row.
+	"""
+	return "INSERT INTO `%s`(%s) VALUES (%s) ON DUPLICATE KEY UPDATE %s" % (table.name,
+		column_names(table.column_names), ", ".join(["%s"] * len(table.columns)),
+		", ".join("`%s` = VALUES(`%s`)" % (name, name) for name in table.column_names if name not in table.primary_key))
 
 
 filterwarnings("ignore", category=MySQLdb.Warning)
 
-
-def price(text):
-	if text is None:
-		return None
-	price = text[1:] if text.startswith("$") else text
-	if not price:
-		return "0.00"
-	return price
-
-class MySQLOutput(AbstractOutputFormat):
-	def __init__(self, host=None, port=None, db=None, user=None, password=None):
+# BIT columns can't be loaded from text directly, they go through a variable
+BIT_COLUMNS = frozenset(column.name for table in TABLES for column in table.columns if column.type == BOOL)
+
+
+def tsv_value(value):
+	"""
+	Formats a value for LOAD DATA's default tab separated format.
+	"""
+	if value is None:
+		return "\\N"
+	if value is True or value is False:
+		return "1" if value else "0"
+	# strftime() refuses years before 1900, e.g. old birthdays
+	if isinstance(value, datetime):
+		return format_sql(value)
+	if isinstance(value, date):
+		return "%04d-%02d-%02d" % (value.year, value.month, value.day)
+	if isinstance(value, unicode):
+		value = value.encode("utf-8")
+	elif not isinstance(value, str):
+		value = str(value)
+	return (value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+		.replace("\r", "\\r").replace("\0", "\\0"))
+
+
+def row_bytes(row):
+	"""
+	Upper bound on the size of row in an INSERT statement.
+	"""
+	size = 4
+	for value in row:
+		if isinstance(value, str):
+			size += 2 * len(value) + 3
+		elif isinstance(value, unicode):
+			# Escaped UTF-8
+			size += 6 * len(value) + 3
+		else:
+			size += 24
+	return size
+
+
+class MySQLOutput(DatabaseOutput):
+	types = TYPES
+	verbs = VERBS
+	placeholder = "%s"
+	writer_name = "graphite-mysql-writer"
+
+	def __init__(self, host=None, port=None, db=None, user=None, password=None, max_buffered_rows=None, dedup=None, changes=None,
+			bulk_load=False, fast_initial_load=False, commit_rows=None, commit_bytes=None,
+			commit_seconds=None, max_packet_bytes=None, background=False, max_pending_writes=None):
+		DatabaseOutput.__init__(self, max_buffered_rows, dedup, changes, background, max_pending_writes)
+		# Group pages into one transaction until one of these is reached,
+		# commit() returns False for the pages in between. By default every
+		# page is committed on its own
+		self.commit_rows = commit_rows
+		self.commit_bytes = commit_bytes
+		self.commit_seconds = commit_seconds
+		# Largest statement executemany() may send, by default just under
+		# the server's max_allowed_packet
+		self.max_packet_bytes = max_packet_bytes
+		# Load buffers with LOAD DATA LOCAL INFILE instead of executemany()
+		self.bulk_load = bulk_load
+		# Turn off unique checks and non-unique index upkeep until complete(),
+		# only safe for a first load into empty tables
+		self.fast_initial_load = fast_initial_load
 		# The MySQLdb.connect() function acts weird if we send it None kwargs
 		self.conn_kwargs = dict(host=host, port=port, db=db, user=user, passwd=password)
 		for name, value in self.conn_kwargs.items():
 			if value is None:
 				del self.conn_kwargs[name]
 		self.conn_kwargs.setdefault("charset", "utf8")
+		if self.bulk_load:
+			self.conn_kwargs["local_infile"] = 1
 		self.conn = self.new_conn()
 		self.create_tables()
 		self.conn.close()
-		self.reset()
 	
 	def new_conn(self):
 		return MySQLdb.connect(**self.conn_kwargs)
-	
-	def reset(self):
-		self.user_profile_inserts = []
-		self.friend_profile_inserts = []
-		self.friend_inserts = []
-		self.object_inserts = []
-		self.object_tag_inserts = []
-		self.action_inserts = []
-		self.sale_inserts = []
-		self.sale_object_inserts = []
-		self.board_inserts = []
-		self.board_object_inserts = []
-		self.follow_inserts = []
-		self.board_action_inserts = []
-		self.user_like_inserts = []
-		self.like_inserts = []
 
+	def upsert_sql(self, table):
+		return upsert_sql(table)
+
+	def database_name(self):
+		return "mysql://%s:%s/%s" % (self.conn_kwargs.get("host", "localhost"), self.conn_kwargs.get("port", 3306),
+			self.conn_kwargs.get("db", ""))
+	
 	def start(self, node_type):
-		# TODO: is there a way to not update indexes, w/o dropping them completely?
 		self.conn = self.new_conn()
 		self.conn.autocommit(False)
 		self.cursor = self.conn.cursor()
-		self.reset()
-
-	def handle(self, node_type, id, node):
-		if node_type is NODE_TYPE_USER:
-			self.user_profile_insert(id, node)
-			friends = node.get("friends")
-			if friends:
-				facebook_id = node["fbid"]
-				for friend_id in friends:
-					# Where are these values coming from?
-#					if isinstance(friend, dict):
-#						friend = friend["id"]
-					self.friend_edge_insert(facebook_id, friend_id)
-		elif node_type is NODE_TYPE_FRIEND:
-			self.friend_profile_insert(id, node)
-		elif node_type is NODE_TYPE_OBJECT:
-			self.object_insert(id, node)
-			for tag in node.get("tags", []):
-				self.object_tag_insert(id, tag)
-		elif node_type is NODE_TYPE_ACTION:
-			if "board_id" in node:
-				self.board_action_insert(id, node)
+		if self.fast_initial_load:
+			# Only the feed's own tables have their keys rebuilt in complete()
+			self.key_tables = NODE_TABLES.get(node_type, TABLES)
+			self.disable_keys()
+		self.packet_bytes = self.max_packet_bytes
+		if self.packet_bytes is None:
+			self.cursor.execute("SHOW VARIABLES LIKE 'max_allowed_packet'")
+			self.packet_bytes = int(self.cursor.fetchone()[1]) * 3 // 4
+		self.in_transaction = False
+		self.transaction_rows = 0
+		self.transaction_bytes = 0
+		self.transaction_started = None
+		DatabaseOutput.start(self, node_type)
+
+	def write_buffers(self, buffers, end=None):
+		"""
+		Writes buffers, a dict of insert buffer name to rows, in the open
+		transaction. At the end of a page the commit thresholds are checked.
+		"""
+		if not self.in_transaction:
+			self.cursor.execute("BEGIN")
+			self.in_transaction = True
+			self.transaction_started = time.time()
+		if self.changes is not None:
+			self.apply_changes(buffers)
+		for insert in self.inserts:
+			rows = buffers[insert.buffer]
+			if not rows:
+				continue
+			if self.bulk_load:
+				self.load_data(insert, rows)
 			else:
-				self.action_insert(id, node)
-		elif node_type is NODE_TYPE_SALE:
-			self.sale_insert(id, node)
-			for object in node["products"]:
-				self.sale_object_insert(id, object)
-		elif node_type in [NODE_TYPE_USER_BOARD, NODE_TYPE_BRAND_BOARD]:
-			self.board_insert(id, node,  node_type is NODE_TYPE_BRAND_BOARD)
-			for object_id in node.get("object_ids", []):
-				self.board_object_insert(id, object_id)
-		elif node_type is NODE_TYPE_FOLLOW:
-			self.follow_insert(id, node)
-		elif node_type is NODE_TYPE_USER_LIKE:
-			# "likes" will exist in node, but may have a value of None
-			likes = node["likes"]
-			if likes:
-				for like in likes:
-					self.user_like_insert(id, like)
-		elif node_type is NODE_TYPE_LIKE:
-			# "likes" will exist in node, but may have a value of None
-			likes = node["likes"]
-			if likes:
-				for like in likes:
-					self.like_insert(id, like)
-
-	def user_profile_insert(self, id, node):
-		self.user_profile_inserts.append(self.profile_row(id, node, True))
-
-	def friend_profile_insert(self, id, node):
-		self.friend_profile_inserts.append(self.profile_row(None, node, False))
-
-	def profile_row(self, id, node, is_user):
-		fbid = node["fbid"]
-		assert fbid, node
-		profile_image = "http://graph.facebook.com/{}/picture".format(fbid)
-		birthday = node.get("birthday")
-		# The birthday string can be in a couple different formats
-		try:
-			birthday = datetime.strptime(birthday, "%Y-%m-%dT%H:%M:%S") if birthday else None
-		except ValueError:
-			try:
-				birthday = datetime.strptime(birthday, "%m/%d/%Y") if birthday else None
-			except ValueError:
-				birthday = None
-		ts = datetime.utcfromtimestamp(float(node["ts"]))
-		return fbid, is_user, id, node.get("name"), node.get("username"), node.get("first_name"), node.get("last_name"), profile_image, node.get("hometown"), node.get("location.name"), node.get("email"), node.get("gender"), birthday, ts
-
-	def friend_edge_insert(self, facebook_id, friend_id):
-		self.friend_inserts.append((facebook_id, friend_id))
-
-	def object_insert(self, id, node):
-		self.object_inserts.append((id, node.get("url", ""), node.get("image", ""), node.get("title", ""), node.get("description"), node.get("price"), node.get("updated", ""), node.get("created", "")))
-
-	def object_tag_insert(self, id, node):
-		self.object_tag_inserts.append((id, node["en"], node["ns"] == "user"))
-
-	def action_insert(self, id, node):
-		self.action_inserts.append((node["uid"], node["oid"], node["action"], node["created"], node.get("deleted")))
-
-	def sale_insert(self, id, node):
-		self.action_inserts.append((node["user"], node["id"], "__sale__", node["created"], None))
-		self.sale_inserts.append((node["id"], node["user"], node.get("order_number"), price(node["total"]), node["created"]))
-
-	def sale_object_insert(self, id, object):
-		self.sale_object_inserts.append((id, object["id"], price(object["price"]), object["qty"]))
-
-	def board_insert(self, id, node, is_brand_board):
-		self.board_inserts.append((id, is_brand_board, node["name"], node.get("user_id"), node.get("created"), node.get("deleted")))
-
-	def board_object_insert(self, id, object_id):
-		self.board_object_inserts.append((id, object_id))
-
-	def board_action_insert(self, id, node):
-		# Set oid to an empty string if it is missing or None
-		oid = node.get("oid") or ""
-		self.board_action_inserts.append((node["board_id"], node["uid"], oid, node["action"], node["created"], node.get("deleted")))
-
-	def follow_insert(self, id, node):
-		self.follow_inserts.append((id, node.get("follower_id", ""), node.get("created"), node.get("deleted")))
-		
-	def user_like_insert(self, id, node):
-		self.user_like_inserts.append((id, node["id"], node["category"], node.get("name"), node.get("created_time")))
-		
-	def like_insert(self, id, node):
-		self.like_inserts.append((id, node["id"], node["category"], node.get("name"), node.get("created_time")))
-		
-	def commit(self):
-		# MySQLdb runs *much* faster if we use executemany() to bulk insert.
-		self.cursor.execute("BEGIN")
-		if self.user_profile_inserts:
-			self.cursor.executemany("""
-				REPLACE INTO profile(facebook_id, is_user, user_id, name, username, first_name, last_name, profile_image, hometown, location, email, gender, birthday, ts)
-				VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-				""", self.user_profile_inserts)
-		if self.friend_profile_inserts:
-			# Don't overwrite any existing row if friend is also a user
-			self.cursor.executemany("""
-				INSERT IGNORE INTO profile(facebook_id, is_user, user_id, name, username, first_name, last_name, profile_image, hometown, location, email, gender, birthday, ts)
-				VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-				""", self.friend_profile_inserts)
-		if self.friend_inserts:
-			self.cursor.executemany("""
-				INSERT IGNORE INTO friend(facebook_id, friend_id)
-				VALUES (%s, %s)
-				""", self.friend_inserts)
-		if self.object_inserts:
-			self.cursor.executemany("""
-				REPLACE INTO object(id, url, image, title, description, price, ts, created)
-				VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-				""", self.object_inserts)
-		if self.object_tag_inserts:
-			self.cursor.executemany("""
-				REPLACE INTO object_tag(object_id, tag, is_user_tag)
-				VALUES (%s, %s, %s)
-				""", self.object_tag_inserts)
-		if self.action_inserts:
-			self.cursor.executemany("""
-				REPLACE INTO action(user_id, object_id, action, created, deleted)
-				VALUES (%s, %s, %s, %s, %s)
-				""", self.action_inserts)
-		if self.sale_inserts:
-			self.cursor.executemany("""
-				INSERT IGNORE INTO sale(sale_id, user_id, order_number, total, ts)
-				VALUES (%s, %s, %s, %s, %s)
-				""", self.sale_inserts)
-		if self.sale_object_inserts:
-			self.cursor.executemany("""
-				INSERT IGNORE INTO sale_object(sale_id, object_id, price, quantity)
-				VALUES (%s, %s, %s, %s)
-				""", self.sale_object_inserts)
-		if self.board_inserts:
-			self.cursor.executemany("""
-				REPLACE INTO board(id, is_brand_board, name, user_id, created, deleted)
-				VALUES (%s, %s, %s, %s, %s, %s)
-				""", self.board_inserts)
-		if self.board_object_inserts:
-			self.cursor.executemany("INSERT IGNORE INTO board_object VALUES (%s, %s)", self.board_object_inserts)
-		if self.board_action_inserts:
-			self.cursor.executemany("""
-				REPLACE INTO board_action(board_id, user_id, object_id, action, created, deleted)
-				VALUES (%s, %s, %s, %s, %s, %s)
-				""", self.board_action_inserts)
-		if self.follow_inserts:
-			self.cursor.executemany("""
-				REPLACE INTO follow(user_id, follower_id, created, deleted)
-				VALUES (%s, %s, %s, %s)
-				""", self.follow_inserts)
-		if self.user_like_inserts:
-			self.cursor.executemany("""
-				REPLACE INTO `user_like`(facebook_id, like_id, category, name, created)
-				VALUES (%s, %s, %s, %s, %s)
-				""", self.user_like_inserts)
-		if self.like_inserts:
-			self.cursor.executemany("""
-				REPLACE INTO `like`(facebook_id, like_id, category, name, created)
-				VALUES (%s, %s, %s, %s, %s)
-				""", self.like_inserts)
+				# MySQLdb runs *much* faster if we use executemany() to bulk insert.
+				self.executemany(self.insert_statements[insert.buffer], rows)
+		if end == "page":
+			self.end_page()
+		elif end == "commit":
+			self.end_transaction()
+		return not self.in_transaction
+
+	def executemany(self, sql, rows):
+		"""
+		cursor.executemany() split into chunks so no statement goes over
+		packet_bytes.
+		"""
+		limit = max(self.packet_bytes - len(sql), 1)
+		chunk, size, total = [], 0, 0
+		for row in rows:
+			n = row_bytes(row)
+			if chunk and size + n > limit:
+				self.cursor.executemany(sql, chunk)
+				chunk, size = [], 0
+			chunk.append(row)
+			size += n
+			total += n
+		if chunk:
+			self.cursor.executemany(sql, chunk)
+		self.transaction_rows += len(rows)
+		self.transaction_bytes += total
+
+	def end_page(self):
+		if self.commit_rows is None and self.commit_bytes is None and self.commit_seconds is None:
+			self.end_transaction()
+		elif ((self.commit_rows is not None and self.transaction_rows >= self.commit_rows)
+				or (self.commit_bytes is not None and self.transaction_bytes >= self.commit_bytes)
+				or (self.commit_seconds is not None and time.time() - self.transaction_started >= self.commit_seconds)):
+			self.end_transaction()
+
+	def end_transaction(self):
 		self.cursor.execute("COMMIT")
-		self.reset()
-		
-	def complete(self):
-		self.conn.close()
-
-	def create_tables(self):
-		cursor = self.conn.cursor()
-		for name, ddl in TABLES:
-			try:
-				print >> sys.stderr, "Creating table {}: ".format(name)
-				cursor.execute(ddl)
-			except Exception as err:
-				print >> sys.stderr, err
-			else:
-				print >> sys.stderr, "OK"
-		cursor.close()
-
+		self.in_transaction = False
+		self.transaction_rows = 0
+		self.transaction_bytes = 0
+		if self.changes is not None:
+			self.changes.commit()
+
+	def load_data(self, insert, rows):
+		table = insert.table
+		f = tempfile.NamedTemporaryFile(prefix="graphite-%s-" % table.name, suffix=".tsv", delete=False)
+		try:
+			for row in rows:
+				f.write("\t".join(tsv_value(value) for value in row))
+				f.write("\n")
+			self.transaction_rows += len(rows)
+			self.transaction_bytes += f.tell()
+			f.close()
+			columns = table.column_names
+			targets = ["@%s" % column if column in BIT_COLUMNS else "`%s`" % column for column in columns]
+			sets = ["`%s` = CAST(@%s AS UNSIGNED)" % (column, column) for column in columns if column in BIT_COLUMNS]
+			sql = "LOAD DATA LOCAL INFILE %%s %s INTO TABLE `%s` CHARACTER SET utf8 (%s)" % (
+				"REPLACE" if insert.on_duplicate == REPLACE else "IGNORE", table.name, ", ".join(targets))
+			if sets:
+				sql += " SET " + ", ".join(sets)
+			self.cursor.execute(sql, (f.name,))
+		finally:
+			f.close()
+			os.remove(f.name)
+
+	def disable_keys(self):
+		self.cursor.execute("SET unique_checks = 0")
+		self.cursor.execute("SET foreign_key_checks = 0")
+		for table in self.key_tables:
+			# Only affects non-unique indexes, and only on MyISAM tables
+			self.cursor.execute("ALTER TABLE `%s` DISABLE KEYS" % table.name)
+
+	def enable_keys(self):
+		for table in self.key_tables:
+			print >> sys.stderr, "Rebuilding keys on {}".format(table.name)
+			self.cursor.execute("ALTER TABLE `%s` ENABLE KEYS" % table.name)
+		self.cursor.execute("SET unique_checks = 1")
+		self.cursor.execute("SET foreign_key_checks = 1")
+
+	def finish(self):
+		if self.fast_initial_load:
+			self.enable_keys()
@@ -0,0 +1,170 @@
+"""
+ParquetOutput writes the rows of graphite.load.schema as Arrow record batches
+into Parquet files, one directory per table (e.g. action/part-00000.parquet),
+with column types taken from the schema: integer ids, timestamps and decimal
+prices. Rows are collected into row groups of row_group_size rows, and low
+cardinality columns are dictionary encoded. Requires pyarrow.
+"""
+import datetime
+import decimal
+import os
+
+import pyarrow
+import pyarrow.parquet
+
+from graphite.load.schema import (TableOutput, BIGINT, INT, ID, VARCHAR, BOOL, DATE,
+	TIMESTAMP, DECIMAL)
+
+
+TYPES = {
+	BIGINT: pyarrow.uint64(),
+	INT: pyarrow.uint32(),
+	ID: pyarrow.string(),
+	VARCHAR: pyarrow.string(),
+	BOOL: pyarrow.bool_(),
+	DATE: pyarrow.date32(),
+	TIMESTAMP: pyarrow.timestamp("s"),
+	DECIMAL: pyarrow.decimal128(9, 2),
+}
+
+DATE_FORMATS = ("sql", "epoch", "iso")
+CENTS = decimal.Decimal("0.01")
+
+
+def arrow_schema(table):
+	return pyarrow.schema([pyarrow.field(column.name, TYPES[column.type]) for column in table.columns])
+
+
+class ParquetOutput(TableOutput):
+	"""
+	dictionary_columns names the string columns to dictionary encode, in
+	whichever tables have them. compression is any Parquet codec pyarrow
+	supports. commit() returns False as a Parquet file is only readable once
+	complete() has closed it.
+	"""
+	directory = None
+	row_group_size = 64 * 1024
+	dictionary_columns = ("action", "category", "gender", "tag")
+	compression = "snappy"
+
+	def __init__(self, directory, row_group_size=None, dictionary_columns=None, compression=None,
+			max_buffered_rows=None, dedup=None):
+		TableOutput.__init__(self, max_buffered_rows, dedup)
+		self.directory = directory
+		if row_group_size:
+			self.row_group_size = row_group_size
+		if dictionary_columns is not None:
+			self.dictionary_columns = tuple(dictionary_columns)
+		if compression:
+			self.compression = compression
+		self.tables = dict((insert.table.name, insert.table) for insert in self.inserts)
+		# Rows waiting for a full row group, by table name
+		self.pending = {}
+		self.writers = {}
+		self.part_numbers = {}
+		self.converters = {
+			BIGINT: self.to_int,
+			INT: self.to_int,
+			ID: self.to_unicode,
+			VARCHAR: self.to_unicode,
+			BOOL: self.to_bool,
+			DATE: self.to_date,
+			TIMESTAMP: self.to_datetime,
+			DECIMAL: self.to_decimal,
+		}
+
+	def start(self, node_type):
+		self.reset()
+
+	def flush(self):
+		buffers = self.take_buffers()
+		for insert in self.inserts:
+			rows = buffers[insert.buffer]
+			if rows:
+				pending = self.pending.setdefault(insert.table.name, [])
+				pending.extend(rows)
+				while len(pending) >= self.row_group_size:
+					self.write_row_group(insert.table, pending[:self.row_group_size])
+					del pending[:self.row_group_size]
+
+	def commit(self):
+		self.flush()
+		return False
+
+	def complete(self):
+		self.flush()
+		for name, rows in self.pending.items():
+			if rows:
+				self.write_row_group(self.tables[name], rows)
+		self.pending = {}
+		for writer in self.writers.values():
+			writer.close()
+		self.writers = {}
+
+	def writer(self, table):
+		writer = self.writers.get(table.name)
+		if writer is None:
+			directory = os.path.join(self.directory, table.name)
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+			# Every complete() closes the parts, later rows and runs go to new ones
+			number = self.part_numbers.get(table.name, 0)
+			while os.path.exists(os.path.join(directory, "part-%05d.parquet" % number)):
+				number += 1
+			self.part_numbers[table.name] = number + 1
+			dictionary = [name for name in table.column_names if name in self.dictionary_columns]
+			writer = pyarrow.parquet.ParquetWriter(os.path.join(directory, "part-%05d.parquet" % number),
+				arrow_schema(table), use_dictionary=dictionary or False, compression=self.compression)
+			self.writers[table.name] = writer
+		return writer
+
+	def write_row_group(self, table, rows):
+		arrays = []
+		for index, column in enumerate(table.columns):
+			convert = self.converters[column.type]
+			arrays.append(pyarrow.array([convert(row[index]) for row in rows], type=TYPES[column.type]))
+		batch = pyarrow.RecordBatch.from_arrays(arrays, table.column_names)
+		self.writer(table).write_table(pyarrow.Table.from_batches([batch]))
+
+	@staticmethod
+	def to_int(value):
+		if value is None or value == "":
+			return None
+		try:
+			return int(value)
+		except ValueError:
+			return None
+
+	@staticmethod
+	def to_unicode(value):
+		if value is None or isinstance(value, unicode):
+			return value
+		if isinstance(value, str):
+			return value.decode("utf-8", "replace")
+		return unicode(value)
+
+	@staticmethod
+	def to_bool(value):
+		if value is None:
+			return None
+		return bool(value)
+
+	def to_date(self, value):
+		value = self.to_datetime(value)
+		if value is None:
+			return None
+		return value.date()
+
+	def to_datetime(self, value):
+		if value is None or isinstance(value, datetime.datetime):
+			return value
+		return self.date_parser.parse_or_none(value, formats=DATE_FORMATS)
+
+	@staticmethod
+	def to_decimal(value):
+		if value is None:
+			return None
+		try:
+			return decimal.Decimal(value).quantize(CENTS)
+		except decimal.InvalidOperation:
+			return None
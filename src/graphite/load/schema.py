@@ -0,0 +1,542 @@
+"""
+Declarative model of the tables the database outputs load into. Each backend
+generates its DDL and insert statements from TABLES and INSERTS, and
+TableOutput turns nodes into the compact per-table row tuples they write, so
+a table is described once for every output.
+"""
+import sys
+
+from graphite.load.base import AbstractOutputFormat, price
+from graphite.load.writer import BackgroundWriter, PendingCommit
+from graphite.transform.dates import DateParser
+from graphite import (NODE_TYPE_USER, NODE_TYPE_FRIEND, NODE_TYPE_OBJECT,
+	NODE_TYPE_ACTION, NODE_TYPE_SALE, NODE_TYPE_USER_BOARD, NODE_TYPE_BRAND_BOARD,
+	NODE_TYPE_FOLLOW, NODE_TYPE_USER_LIKE, NODE_TYPE_LIKE)
+
+
+# Column types, each backend maps these onto its own
+BIGINT = "bigint"
+INT = "int"
+ID = "id"
+VARCHAR = "varchar"
+BOOL = "bool"
+DATE = "date"
+TIMESTAMP = "timestamp"
+DECIMAL = "decimal"
+
+REPLACE = "replace"
+IGNORE = "ignore"
+
+
+class Column(object):
+	"""
+	nullable is None when the DDL leaves it to the database default.
+	"""
+	def __init__(self, name, type, length=None, nullable=None):
+		self.name = name
+		self.type = type
+		self.length = length
+		self.nullable = nullable
+
+
+class Table(object):
+	"""
+	Rows are tuples in column order. When track_changes is set a
+	graphite.load.changes.ChangeStore can be used to skip unchanged rows, the
+	primary key of those tables is the first column.
+	"""
+	def __init__(self, name, columns, primary_key, indexes=(), track_changes=False):
+		self.name = name
+		self.columns = columns
+		self.primary_key = primary_key
+		self.indexes = indexes
+		self.track_changes = track_changes
+
+	@property
+	def column_names(self):
+		return [column.name for column in self.columns]
+
+
+class Insert(object):
+	"""
+	An insert buffer of TableOutput, buffer rows are written to table and on
+	a duplicate key either replace the stored row or are ignored.
+	"""
+	def __init__(self, buffer, table, on_duplicate):
+		self.buffer = buffer
+		self.table = table
+		self.on_duplicate = on_duplicate
+
+
+PROFILE = Table("profile", [
+	Column("facebook_id", BIGINT, nullable=False),
+	Column("is_user", BOOL),
+	Column("user_id", ID, nullable=True),
+	Column("name", VARCHAR, 128),
+	Column("username", VARCHAR, 128),
+	Column("first_name", VARCHAR, 128),
+	Column("last_name", VARCHAR, 128),
+	Column("profile_image", VARCHAR, 512),
+	Column("hometown", VARCHAR, 128),
+	Column("location", VARCHAR, 128),
+	Column("email", VARCHAR, 128),
+	Column("gender", VARCHAR, 10),
+	Column("birthday", DATE),
+	Column("ts", TIMESTAMP),
+], ("facebook_id",), indexes=[("user_id",)], track_changes=True)
+
+FRIEND = Table("friend", [
+	Column("facebook_id", BIGINT, nullable=False),
+	Column("friend_id", BIGINT, nullable=False),
+], ("facebook_id", "friend_id"))
+
+OBJECT = Table("object", [
+	Column("id", ID, nullable=False),
+	Column("url", VARCHAR, 512),
+	Column("image", VARCHAR, 512),
+	Column("title", VARCHAR, 512),
+	Column("description", VARCHAR, 512),
+	Column("price", VARCHAR, 20),
+	Column("ts", TIMESTAMP),
+	Column("created", TIMESTAMP),
+], ("id",), track_changes=True)
+
+OBJECT_TAG = Table("object_tag", [
+	Column("object_id", ID, nullable=False),
+	Column("tag", VARCHAR, 512, nullable=False),
+	Column("is_user_tag", BOOL, nullable=False),
+], ("object_id", "tag"))
+
+ACTION = Table("action", [
+	Column("user_id", ID, nullable=False),
+	Column("object_id", ID, nullable=False),
+	Column("action", VARCHAR, 32, nullable=False),
+	Column("created", TIMESTAMP, nullable=False),
+	Column("deleted", TIMESTAMP, nullable=True),
+], ("user_id", "object_id", "action"))
+
+SALE = Table("sale", [
+	Column("sale_id", ID, nullable=False),
+	Column("user_id", ID, nullable=False),
+	Column("order_number", VARCHAR, 32),
+	Column("total", DECIMAL, nullable=False),
+	Column("ts", TIMESTAMP, nullable=False),
+], ("sale_id",))
+
+SALE_OBJECT = Table("sale_object", [
+	Column("sale_id", ID, nullable=False),
+	Column("object_id", ID, nullable=False),
+	Column("price", DECIMAL, nullable=False),
+	Column("quantity", INT, nullable=False),
+], ("sale_id", "object_id"))
+
+BOARD = Table("board", [
+	Column("id", ID, nullable=False),
+	Column("is_brand_board", BOOL, nullable=False),
+	Column("name", VARCHAR, 128, nullable=False),
+	Column("user_id", ID, nullable=True),
+	Column("created", TIMESTAMP, nullable=True),
+	Column("deleted", TIMESTAMP, nullable=True),
+], ("id",), track_changes=True)
+
+BOARD_OBJECT = Table("board_object", [
+	Column("board_id", ID, nullable=False),
+	Column("object_id", ID, nullable=False),
+], ("board_id", "object_id"))
+
+FOLLOW = Table("follow", [
+	Column("user_id", ID, nullable=False),
+	Column("follower_id", ID, nullable=False),
+	Column("created", TIMESTAMP, nullable=False),
+	Column("deleted", TIMESTAMP, nullable=True),
+], ("user_id", "follower_id"))
+
+BOARD_ACTION = Table("board_action", [
+	Column("board_id", ID, nullable=False),
+	Column("user_id", ID, nullable=False),
+	Column("object_id", ID, nullable=True),
+	Column("action", VARCHAR, 32, nullable=False),
+	Column("created", TIMESTAMP, nullable=False),
+	Column("deleted", TIMESTAMP, nullable=True),
+], ("board_id", "user_id", "object_id", "action"))
+
+USER_LIKE = Table("user_like", [
+	Column("facebook_id", BIGINT, nullable=False),
+	Column("like_id", BIGINT, nullable=False),
+	Column("category", VARCHAR, 32, nullable=False),
+	Column("name", VARCHAR, 512, nullable=True),
+	Column("created", TIMESTAMP, nullable=True),
+], ("facebook_id", "like_id"))
+
+LIKE = Table("like", USER_LIKE.columns, USER_LIKE.primary_key)
+
+TABLES = [PROFILE, FRIEND, OBJECT, OBJECT_TAG, ACTION, SALE, SALE_OBJECT, BOARD,
+	BOARD_OBJECT, FOLLOW, BOARD_ACTION, USER_LIKE, LIKE]
+
+# In write order
+INSERTS = [
+	Insert("user_profile_inserts", PROFILE, REPLACE),
+	# Don't overwrite any existing row if friend is also a user
+	Insert("friend_profile_inserts", PROFILE, IGNORE),
+	Insert("friend_inserts", FRIEND, IGNORE),
+	Insert("object_inserts", OBJECT, REPLACE),
+	Insert("object_tag_inserts", OBJECT_TAG, REPLACE),
+	Insert("action_inserts", ACTION, REPLACE),
+	Insert("sale_inserts", SALE, IGNORE),
+	Insert("sale_object_inserts", SALE_OBJECT, IGNORE),
+	Insert("board_inserts", BOARD, REPLACE),
+	Insert("board_object_inserts", BOARD_OBJECT, IGNORE),
+	Insert("board_action_inserts", BOARD_ACTION, REPLACE),
+	Insert("follow_inserts", FOLLOW, REPLACE),
+	Insert("user_like_inserts", USER_LIKE, REPLACE),
+	Insert("like_inserts", LIKE, REPLACE),
+]
+
+# Tables the rows of each node type are written to
+NODE_TABLES = {
+	NODE_TYPE_USER: [PROFILE, FRIEND],
+	NODE_TYPE_FRIEND: [PROFILE],
+	NODE_TYPE_OBJECT: [OBJECT, OBJECT_TAG],
+	NODE_TYPE_ACTION: [ACTION, BOARD_ACTION],
+	NODE_TYPE_SALE: [ACTION, SALE, SALE_OBJECT],
+	NODE_TYPE_USER_BOARD: [BOARD, BOARD_OBJECT],
+	NODE_TYPE_BRAND_BOARD: [BOARD, BOARD_OBJECT],
+	NODE_TYPE_FOLLOW: [FOLLOW],
+	NODE_TYPE_USER_LIKE: [USER_LIKE],
+	NODE_TYPE_LIKE: [LIKE],
+}
+
+BIRTHDAY_FORMATS = ("iso", "us")
+TS_FORMATS = ("epoch",)
+
+
+def column_names(names):
+	return ", ".join("`%s`" % name for name in names)
+
+
+def create_table_sql(table, types, inline_indexes=True):
+	"""
+	types maps the column types onto the backend's, VARCHAR's takes the
+	length. Without inline_indexes the indexes need create_index_sql().
+	"""
+	lines = []
+	for column in table.columns:
+		line = "`%s` %s" % (column.name, types[column.type] % column.length if column.length else types[column.type])
+		if column.nullable is not None:
+			line += " NULL" if column.nullable else " NOT NULL"
+		lines.append(line)
+	lines.append("PRIMARY KEY (%s)" % column_names(table.primary_key))
+	if inline_indexes:
+		for index in table.indexes:
+			lines.append("INDEX (%s)" % column_names(index))
+	return "CREATE TABLE IF NOT EXISTS `%s` (%s)" % (table.name, ", ".join(lines))
+
+
+def create_index_sql(table, index):
+	return "CREATE INDEX IF NOT EXISTS `%s_%s` ON `%s` (%s)" % (table.name, "_".join(index), table.name, column_names(index))
+
+
+def insert_sql(insert, verbs, placeholder):
+	"""
+	verbs maps REPLACE and IGNORE to the statement's leading keywords.
+	"""
+	return "%s INTO `%s`(%s) VALUES (%s)" % (verbs[insert.on_duplicate], insert.table.name,
+		column_names(insert.table.column_names), ", ".join([placeholder] * len(insert.table.columns)))
+
+
+class TableOutput(AbstractOutputFormat):
+	"""
+	Base for outputs that load nodes into TABLES. Rows are collected in one
+	buffer per entry of INSERTS, subclasses write them in flush().
+	"""
+	inserts = INSERTS
+	max_buffered_rows = None
+	dedup = None
+
+	def __init__(self, max_buffered_rows=None, dedup=None):
+		self.max_buffered_rows = max_buffered_rows
+		# Optional graphite.load.dedup index, drops friend edges and friend
+		# profiles already sent this run. Only these INSERT IGNOREd rows are
+		# checked, so a false positive never loses data
+		self.dedup = dedup
+		self.insert_buffers = tuple(insert.buffer for insert in self.inserts)
+		self.date_parser = DateParser()
+		self.reset()
+
+	def reset(self):
+		for name in self.insert_buffers:
+			setattr(self, name, [])
+
+	def take_buffers(self):
+		buffers = dict((name, getattr(self, name)) for name in self.insert_buffers)
+		self.reset()
+		return buffers
+
+	def buffered_rows(self):
+		return sum(len(getattr(self, name)) for name in self.insert_buffers)
+
+	def _check_buffer(self):
+		if self.max_buffered_rows and self.buffered_rows() >= self.max_buffered_rows:
+			self.flush()
+
+	def flush(self):
+		raise Exception("unimplemented")
+
+	def handle(self, node_type, id, node):
+		if node_type is NODE_TYPE_USER:
+			self.user_profile_insert(id, node)
+			friends = node.get("friends")
+			if friends:
+				facebook_id = node["fbid"]
+				for friend_id in friends:
+					# Where are these values coming from?
+#					if isinstance(friend, dict):
+#						friend = friend["id"]
+					self.friend_edge_insert(facebook_id, friend_id)
+		elif node_type is NODE_TYPE_FRIEND:
+			self.friend_profile_insert(id, node)
+		elif node_type is NODE_TYPE_OBJECT:
+			self.object_insert(id, node)
+			for tag in node.get("tags", []):
+				self.object_tag_insert(id, tag)
+		elif node_type is NODE_TYPE_ACTION:
+			if node.get("board_id") is not None:
+				self.board_action_insert(id, node)
+			else:
+				self.action_insert(id, node)
+		elif node_type is NODE_TYPE_SALE:
+			self.sale_insert(id, node)
+			for object in node["products"]:
+				self.sale_object_insert(id, object)
+		elif node_type in [NODE_TYPE_USER_BOARD, NODE_TYPE_BRAND_BOARD]:
+			self.board_insert(id, node,  node_type is NODE_TYPE_BRAND_BOARD)
+			for object_id in node.get("object_ids", []):
+				self.board_object_insert(id, object_id)
+		elif node_type is NODE_TYPE_FOLLOW:
+			self.follow_insert(id, node)
+		elif node_type is NODE_TYPE_USER_LIKE:
+			# "likes" will exist in node, but may have a value of None
+			likes = node["likes"]
+			if likes:
+				for like in likes:
+					self.user_like_insert(id, like)
+		elif node_type is NODE_TYPE_LIKE:
+			# "likes" will exist in node, but may have a value of None
+			likes = node["likes"]
+			if likes:
+				for like in likes:
+					self.like_insert(id, like)
+		self._check_buffer()
+
+	def handle_columns(self, node_type, batch):
+		if node_type is not NODE_TYPE_ACTION or batch.column("board_id") is None:
+			return AbstractOutputFormat.handle_columns(self, node_type, batch)
+		rows = zip(batch.column("board_id"), batch.column("uid"), batch.column("oid"),
+			batch.column("action"), batch.column("created"), batch.column("deleted"))
+		for board_id, uid, oid, action, created, deleted in rows:
+			if board_id is not None:
+				self.board_action_inserts.append((board_id, uid, oid or "", action, created, deleted))
+			else:
+				self.action_inserts.append((uid, oid, action, created, deleted))
+			if self.max_buffered_rows and len(self.action_inserts) + len(self.board_action_inserts) >= self.max_buffered_rows:
+				self.flush()
+
+	def user_profile_insert(self, id, node):
+		# REPLACEd, so never dropped by dedup, ChangeStore skips unchanged ones
+		self.user_profile_inserts.append(self.profile_row(id, node, True))
+
+	def friend_profile_insert(self, id, node):
+		# Friend profiles are INSERT IGNOREd, only the first one for an fbid counts
+		if self.dedup is not None and self.dedup.seen(("friend_profile", node["fbid"])):
+			return
+		self.friend_profile_inserts.append(self.profile_row(None, node, False))
+
+	def profile_row(self, id, node, is_user):
+		fbid = node["fbid"]
+		assert fbid, node
+		profile_image = "http://graph.facebook.com/{}/picture".format(fbid)
+		# The birthday string can be in a couple different formats
+		birthday = self.date_parser.parse_or_none(node.get("birthday"), "birthday", BIRTHDAY_FORMATS)
+		ts = self.date_parser.parse(node["ts"], "ts", TS_FORMATS)
+		return fbid, is_user, id, node.get("name"), node.get("username"), node.get("first_name"), node.get("last_name"), profile_image, node.get("hometown"), node.get("location.name"), node.get("email"), node.get("gender"), birthday, ts
+
+	def friend_edge_insert(self, facebook_id, friend_id):
+		if self.dedup is not None and self.dedup.seen((facebook_id, friend_id)):
+			return
+		self.friend_inserts.append((facebook_id, friend_id))
+
+	def object_insert(self, id, node):
+		self.object_inserts.append((id, node.get("url", ""), node.get("image", ""), node.get("title", ""), node.get("description"), node.get("price"), node.get("updated", ""), node.get("created", "")))
+
+	def object_tag_insert(self, id, node):
+		self.object_tag_inserts.append((id, node["en"], node["ns"] == "user"))
+
+	def action_insert(self, id, node):
+		self.action_inserts.append((node["uid"], node["oid"], node["action"], node["created"], node.get("deleted")))
+
+	def sale_insert(self, id, node):
+		self.action_inserts.append((node["user"], node["id"], "__sale__", node["created"], None))
+		self.sale_inserts.append((node["id"], node["user"], node.get("order_number"), price(node["total"]), node["created"]))
+
+	def sale_object_insert(self, id, object):
+		self.sale_object_inserts.append((id, object["id"], price(object["price"]), object["qty"]))
+
+	def board_insert(self, id, node, is_brand_board):
+		self.board_inserts.append((id, is_brand_board, node["name"], node.get("user_id"), node.get("created"), node.get("deleted")))
+
+	def board_object_insert(self, id, object_id):
+		self.board_object_inserts.append((id, object_id))
+
+	def board_action_insert(self, id, node):
+		# Set oid to an empty string if it is missing or None
+		oid = node.get("oid") or ""
+		self.board_action_inserts.append((node["board_id"], node["uid"], oid, node["action"], node["created"], node.get("deleted")))
+
+	def follow_insert(self, id, node):
+		self.follow_inserts.append((id, node.get("follower_id", ""), node.get("created"), node.get("deleted")))
+
+	def user_like_insert(self, id, node):
+		self.user_like_inserts.append((id, node["id"], node["category"], node.get("name"), node.get("created_time")))
+
+	def like_insert(self, id, node):
+		self.like_inserts.append((id, node["id"], node["category"], node.get("name"), node.get("created_time")))
+
+
+class DatabaseOutput(TableOutput):
+	"""
+	Base for the outputs writing TABLES through a DB-API connection.
+	Subclasses set types, verbs and placeholder, open self.conn and
+	self.cursor in start() before calling DatabaseOutput.start(), and
+	implement write_buffers(buffers, end). end is None mid page, "page" at
+	the end of a page and "commit" to commit regardless, write_buffers()
+	returns whether the rows are committed.
+
+	With background set writes run on a graphite.load.writer.BackgroundWriter
+	thread, holding up to max_pending_writes batches of rows waiting for it.
+	changes is an optional graphite.load.changes.ChangeStore, unchanged rows
+	of tables that track changes are skipped and changed ones written with
+	upsert_sql(), which subclasses implement, instead of the plain insert.
+	The hashes are kept under database_name(), so outputs writing to
+	different databases can share a store.
+	"""
+	types = None
+	verbs = None
+	placeholder = None
+	inline_indexes = True
+	writer_name = "graphite-writer"
+
+	def __init__(self, max_buffered_rows=None, dedup=None, changes=None, background=False, max_pending_writes=None):
+		TableOutput.__init__(self, max_buffered_rows, dedup)
+		self.change_store = changes
+		# ChangeSession of the store, opened in start()
+		self.changes = None
+		self.background = background
+		self.max_pending_writes = max_pending_writes
+		self.writer = None
+		self.insert_statements = dict((insert.buffer, insert_sql(insert, self.verbs, self.placeholder))
+			for insert in self.inserts)
+		self.upsert_statements = dict((table.name, self.upsert_sql(table)) for table in TABLES if table.track_changes)
+
+	def upsert_sql(self, table):
+		"""
+		INSERT of a table row that overwrites the stored row with its key.
+		"""
+		raise Exception("unimplemented")
+
+	def database_name(self):
+		raise Exception("unimplemented")
+
+	def start(self, node_type):
+		if self.change_store is not None:
+			self.changes = self.change_store.session(self.database_name())
+		self.reset()
+		if self.background:
+			# The connection belongs to the writer thread from here on
+			self.writer = BackgroundWriter(self.write_buffers, self.max_pending_writes, self.writer_name)
+
+	def submit(self, end=None):
+		"""
+		Passes the buffered rows to write_buffers(), on the writer thread in
+		background mode where a PendingCommit for them is returned.
+		"""
+		buffers = self.take_buffers()
+		if self.writer is not None:
+			return PendingCommit([(self.writer, self.writer.submit(buffers, end))])
+		return self.write_buffers(buffers, end)
+
+	def write_buffers(self, buffers, end=None):
+		raise Exception("unimplemented")
+
+	def flush(self):
+		"""
+		Writes the buffered rows inside the open transaction, commit() ends it.
+		"""
+		self.submit()
+
+	def commit(self):
+		"""
+		Called after every page, returns False while the page is not
+		committed yet. In background mode it returns a PendingCommit instead.
+		"""
+		return self.submit("page")
+
+	def commit_transaction(self):
+		"""
+		Writes any buffered rows and commits, waiting for the writer in
+		background mode.
+		"""
+		self.submit("commit")
+		if self.writer is not None:
+			self.writer.drain()
+
+	def executemany(self, sql, rows):
+		self.cursor.executemany(sql, rows)
+
+	def apply_changes(self, buffers):
+		"""
+		Drops unchanged rows from the replacing buffers of tables that track
+		changes and upserts changed ones, leaving only new rows to insert.
+		Changed rows are not UPDATEd, the stored row may be gone.
+		"""
+		for insert in self.inserts:
+			if insert.on_duplicate != REPLACE or not insert.table.track_changes:
+				continue
+			buffers[insert.buffer], changed = self.changes.classify(insert.table.name, buffers[insert.buffer])
+			if changed:
+				self.executemany(self.upsert_statements[insert.table.name], changed)
+
+	def complete(self):
+		try:
+			if self.writer is not None:
+				writer, self.writer = self.writer, None
+				try:
+					writer.submit(self.take_buffers(), "commit")
+				finally:
+					writer.close()
+			else:
+				self.submit("commit")
+			self.finish()
+		finally:
+			self.conn.close()
+
+	def finish(self):
+		"""
+		Runs in complete() once everything is committed, before the
+		connection is closed.
+		"""
+		pass
+
+	def create_tables(self):
+		cursor = self.conn.cursor()
+		for table in TABLES:
+			try:
+				print >> sys.stderr, "Creating table {}: ".format(table.name)
+				cursor.execute(create_table_sql(table, self.types, self.inline_indexes))
+				if not self.inline_indexes:
+					for index in table.indexes:
+						cursor.execute(create_index_sql(table, index))
+			except Exception as err:
+				print >> sys.stderr, err
+			else:
+				print >> sys.stderr, "OK"
+		cursor.close()
@@ -1,100 +1,84 @@
-from graphite.load import AbstractOutputFormat
-from graphite.extract.base import NODE_TYPE_USER
+from graphite.load.schema import (DatabaseOutput, Insert, insert_sql, REPLACE, IGNORE, BIGINT, INT,
+	ID, VARCHAR, BOOL, DATE, TIMESTAMP, DECIMAL)
+import os
 import sqlite3
-import sys
 
-TABLES = []
-TABLES.append(('user',
-	"CREATE TABLE IF NOT EXISTS `user` ("
-	"  `user_id` BIGINT UNSIGNED NOT NULL,"
-	"  `name` varchar(128),"
-	"  `username` varchar(128),"
-	"  `first_name` varchar(128),"
-	"  `last_name` varchar(128),"
-	"  `profile_image` varchar(512),"
-	"  `ts` TIMESTAMP,"
-	"  PRIMARY KEY (`user_id`) ON CONFLICT REPLACE"
-	")")
-)
-TABLES.append(('friend',
-	"CREATE TABLE IF NOT EXISTS `friend` ("
-	"  `user_id` BIGINT UNSIGNED NOT NULL,"
-	"  `friend_id` BIGINT UNSIGNED NOT NULL,"
-	"  CONSTRAINT relation_edge UNIQUE (`user_id`, `friend_id`) ON CONFLICT IGNORE"
-	")")
-)
 
-TABLES.append(('object',
-	"CREATE TABLE IF NOT EXISTS `friend` ("
-	"  `id` BIGINT UNSIGNED NOT NULL,"
-	"  `friend_id` BIGINT UNSIGNED NOT NULL,"
-	"  `url` varchar(512),"
-	"  `image` varchar(512),"
-	"  `title` varchar(512),"
-	"  `description` varchar(512),"
-	"  `price` varchar(512),"
-	"  `ts` TIMESTAMP,"
-	"  PRIMARY KEY (`id`) ON CONFLICT REPLACE"
-	")")
-)
+TYPES = {
+	BIGINT: "BIGINT UNSIGNED",
+	INT: "INT UNSIGNED",
+	ID: "CHAR(24)",
+	VARCHAR: "varchar(%d)",
+	BOOL: "BOOLEAN",
+	DATE: "date",
+	TIMESTAMP: "TIMESTAMP",
+	DECIMAL: "decimal(9,2)",
+}
 
-TABLES.append(('action',
-	"CREATE TABLE IF NOT EXISTS `action` ("
-	"  `id` BIGINT UNSIGNED NOT NULL,"
-	"  `user_id` BIGINT UNSIGNED NOT NULL,"
-	"  `object_id` BIGINT UNSIGNED NOT NULL,"
-	"  `created` TIMESTAMP,"
-	"  `deleted` TIMESTAMP,"
-	"  `action` varchar(32),"
-	"  PRIMARY KEY (`id`) ON CONFLICT REPLACE"
-	")")
-)
+VERBS = {
+	REPLACE: "INSERT OR REPLACE",
+	IGNORE: "INSERT OR IGNORE",
+}
 
 
-class SqliteOutput(AbstractOutputFormat):
+class SqliteOutput(DatabaseOutput):
 	filename = None
-	tables = None
+	types = TYPES
+	verbs = VERBS
+	placeholder = "?"
+	inline_indexes = False
+	writer_name = "graphite-sqlite-writer"
 
-	def __init__(self, filename=None, **kwds):
+	def __init__(self, filename=None, dedup=None, changes=None, background=False, max_pending_writes=None,
+			max_buffered_rows=None, journal_mode=None, synchronous=None, cache_size=None, **kwds):
+		DatabaseOutput.__init__(self, max_buffered_rows, dedup, changes, background, max_pending_writes)
 		self.filename = filename
+		# PRAGMAs set on every connection, e.g. journal_mode="WAL" and
+		# synchronous="NORMAL" to fsync at checkpoints instead of every
+		# commit. cache_size is in pages, or KiB when negative
+		self.journal_mode = journal_mode
+		self.synchronous = synchronous
+		self.cache_size = cache_size
 		if self.filename is None:
 			self.filename = "igapi-example.db"
 		self.conn = sqlite3.connect(self.filename)
 		self.create_tables()
 		self.conn.close()
 
-	def start(self, node_type):
-		self.conn = sqlite3.connect(self.filename)
-		self.cursor = self.conn.cursor()
+	def upsert_sql(self, table):
+		return insert_sql(Insert(None, table, REPLACE), self.verbs, self.placeholder)
 
-	def handle(self, node_type, id, node):
-		if node_type is NODE_TYPE_USER:
-			self.user_insert(id, node)
-			for friend in node.get("friends", []):
-				self.friend_edge_insert(id, friend)
-			self.conn.commit()
+	def database_name(self):
+		return "sqlite://" + os.path.abspath(self.filename)
 
-	def user_insert(self, id, node):
-		self.cursor.execute("INSERT INTO user VALUES (?, ?, ?, ?, ?)", (id, node.get("name", ""), node.get("username", ""), node.get("first_name", ""), node.get("last_name", "")))
-
-	def friend_edge_insert(self, id, friend):
-		self.cursor.execute("INSERT INTO friend VALUES (?, ?)", [id, friend])
+	def start(self, node_type):
+		# Calls may come from any thread, e.g. the feed threads sharing a
+		# SynchronizedOutput or the writer thread in background mode, but
+		# never from two at once
+		self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+		self.cursor = self.conn.cursor()
+		if self.journal_mode is not None:
+			self.cursor.execute("PRAGMA journal_mode = %s" % self.journal_mode)
+		if self.synchronous is not None:
+			self.cursor.execute("PRAGMA synchronous = %s" % self.synchronous)
+		if self.cache_size is not None:
+			self.cursor.execute("PRAGMA cache_size = %d" % self.cache_size)
+		DatabaseOutput.start(self, node_type)
 
-	def commit(self):
+	def write_buffers(self, buffers, end=None):
+		"""
+		Writes buffers, a dict of insert buffer name to rows, committing
+		them unless end is None.
+		"""
+		if self.changes is not None:
+			self.apply_changes(buffers)
+		for insert in self.inserts:
+			rows = buffers[insert.buffer]
+			if rows:
+				self.cursor.executemany(self.insert_statements[insert.buffer], rows)
+		if end is None:
+			return False
 		self.conn.commit()
-
-	def complete(self):
-		self.conn.close()
-
-	def create_tables(self):
-		cursor = self.conn.cursor()
-		for name, ddl in TABLES:
-			try:
-				print >> sys.stderr, "Creating table {}: ".format(name)
-				cursor.execute(ddl)
-			except Exception as err:
-				print >> sys.stderr, err
-			else:
-				print >> sys.stderr, "OK"
-		cursor.close()
-
+		if self.changes is not None:
+			self.changes.commit()
+		return True
@@ -0,0 +1,94 @@
+"""
+BackgroundWriter runs an output's database writes on a dedicated thread, so
+writing one page overlaps fetching and transforming the next. Batches are
+handed over through a bounded queue, submit() blocks once max_pending of
+them are waiting. An error in the writer is re-raised on the next submit(),
+drain() or close(), and nothing further is written after it.
+
+Batches are numbered as they are submitted, when write() returns True the
+batch and everything before it count as committed. A PendingCommit tells
+the extractor when the page it was returned for has been committed.
+"""
+import Queue
+import sys
+import threading
+
+
+class BackgroundWriter(object):
+	max_pending = 2
+
+	def __init__(self, write, max_pending=None, name="graphite-writer"):
+		self.write = write
+		if max_pending:
+			self.max_pending = max_pending
+		self.queue = Queue.Queue(self.max_pending)
+		self.error = None
+		self.submitted = 0
+		# Number of the last batch committed
+		self.committed = 0
+		self.thread = threading.Thread(target=self.run, name=name)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def run(self):
+		while True:
+			batch = self.queue.get()
+			try:
+				if batch is None:
+					return
+				sequence, args = batch
+				if self.error is None and self.write(*args):
+					self.committed = sequence
+			except Exception:
+				self.error = sys.exc_info()
+			finally:
+				self.queue.task_done()
+
+	def check(self):
+		if self.error is not None:
+			raise self.error[0], self.error[1], self.error[2]
+
+	def submit(self, *args):
+		"""
+		Queues write(*args) to run on the writer thread, returns the number
+		of the batch.
+		"""
+		self.check()
+		self.submitted += 1
+		self.queue.put((self.submitted, args))
+		return self.submitted
+
+	def drain(self):
+		"""
+		Waits until everything submitted so far has been written.
+		"""
+		self.queue.join()
+		self.check()
+
+	def close(self):
+		"""
+		Writes what is left and stops the thread.
+		"""
+		self.queue.put(None)
+		self.thread.join()
+		self.check()
+
+
+class PendingCommit(object):
+	"""
+	What commit() returns when the page is committed on writer threads
+	later on: writes are (BackgroundWriter, batch number) pairs, done()
+	turns True once every writer has committed up to its batch.
+	"""
+	def __init__(self, writes):
+		self.writes = writes
+
+	def done(self):
+		for writer, sequence in self.writes:
+			if writer.committed < sequence:
+				return False
+		return True
+
+	@classmethod
+	def join(cls, commits):
+		return cls([write for commit in commits for write in commit.writes])
@@ -1 +1 @@
-from graphite.transform.base import AbstractTransformer, TransformerChain
+from graphite.transform.base import AbstractTransformer, TransformerChain, ColumnBatch, handle_batch, flatten_results
@@ -1,4 +1,4 @@
-from graphite.transform import AbstractTransformer
+from graphite.transform import AbstractTransformer, handle_batch
 
 
 class ActionsSerializer(AbstractTransformer):
@@ -8,6 +8,20 @@ class ActionsSerializer(AbstractTransformer):
 		self.transform = transform
 
 	def handle(self, node_type, id, node):
+		for result in self.serialize(node):
+			if self.transform:
+				result = self.transform.handle(node_type, id, result)
+			yield result
+
+	def handle_batch(self, node_type, items):
+		# Yields one (id, action) pair per action, the whole page of actions
+		# goes through the nested transform as a single batch
+		results = ((id, result) for id, node in items for result in self.serialize(node))
+		if self.transform:
+			results = handle_batch(self.transform, node_type, results)
+		return results
+
+	def serialize(self, node):
 		user_id = node.get("id")
 		user_boards = node.get("user_boards", {})
 		brand_boards = node.get("brand_boards", {})
@@ -23,8 +37,6 @@ class ActionsSerializer(AbstractTransformer):
 					"created": action["created"],
 					"deleted": action.get("deleted")
 				}
-				if self.transform:
-					result = self.transform.handle(node_type, id, result)
 				yield result
 		objects = node.get("objects", [])
 		for object_id in objects:
@@ -39,6 +51,4 @@ class ActionsSerializer(AbstractTransformer):
 					"created": action.get("created"),
 					"deleted": action.get("deleted")
 				}
-				if self.transform:
-					result = self.transform.handle(node_type, id, result)
 				yield result
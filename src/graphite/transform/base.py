@@ -1,3 +1,4 @@
+import itertools
 import sys
 
 class AbstractTransformer(object):
@@ -8,6 +9,18 @@ class AbstractTransformer(object):
 		print >> sys.stderr, "%s %s node noticed" % (node_type, id)
 		return node
 
+	def handle_batch(self, node_type, items):
+		"""
+		Batch form of handle, takes an iterable of (id, node) pairs and yields
+		(id, result) pairs. Results are what handle would return, None results
+		may be left out. Override to process a whole page in one loop.
+		"""
+		handle = self.handle
+		for id, node in items:
+			result = handle(node_type, id, node)
+			if result is not None:
+				yield id, result
+
 
 class TransformerChain(AbstractTransformer):
 	transformers = None
@@ -28,3 +41,79 @@ class TransformerChain(AbstractTransformer):
 				# short circuit, stop the chain if a transformer returns none
 				return current_node
 		return current_node
+
+	def handle_batch(self, node_type, items):
+		for transformer in self.transformers:
+			items = handle_batch(transformer, node_type, items)
+		return items
+
+
+def handle_batch(transformer, node_type, items):
+	"""
+	Runs items through transformer.handle_batch, falling back on handle for
+	transformers that don't derive from AbstractTransformer.
+	"""
+	batch = getattr(transformer, "handle_batch", None)
+	if batch is not None:
+		return batch(node_type, items)
+	return _handle_each(transformer, node_type, items)
+
+
+def _handle_each(transformer, node_type, items):
+	handle = transformer.handle
+	for id, node in items:
+		result = handle(node_type, id, node)
+		if result is not None:
+			yield id, result
+
+
+def flatten_results(results):
+	"""
+	Turns (id, result) pairs into (id, node) pairs, expanding results that
+	are iterables of nodes rather than a single dict.
+	"""
+	for id, result in results:
+		if result is None:
+			continue
+		if isinstance(result, dict):
+			yield id, result
+		else:
+			for node in result:
+				yield id, node
+
+
+class ColumnBatch(object):
+	"""
+	A page of transformed rows stored as named columns. Every column is a
+	sequence (a list or a numpy array) with one value per row, ids holds the
+	node id each row came from.
+	"""
+	columns = None
+	ids = None
+
+	def __init__(self, columns, ids):
+		self.columns = columns
+		self.ids = ids
+
+	def __len__(self):
+		return len(self.ids)
+
+	def column(self, name):
+		"""
+		Returns the column as a list, or None if there is no such column.
+		"""
+		values = self.columns.get(name)
+		if values is None:
+			return None
+		if hasattr(values, "tolist"):
+			values = values.tolist()
+		return values
+
+	def rows(self):
+		"""
+		Yields (id, node) pairs, for outputs that don't take columns.
+		"""
+		names = list(self.columns)
+		columns = [self.column(name) for name in names]
+		for id, values in itertools.izip(self.ids, itertools.izip(*columns)):
+			yield id, dict(itertools.izip(names, values))
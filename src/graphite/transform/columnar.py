@@ -0,0 +1,93 @@
+"""
+Columnar transforms, these turn a whole page into a ColumnBatch and do the
+per-row conversions as vectorized numpy operations. process_set passes the
+batch straight to outputs that implement handle_columns. Requires numpy.
+"""
+import numpy
+
+from graphite.transform import AbstractTransformer, ColumnBatch
+
+
+def sql_dates(values):
+	"""
+	Vectorized SQLDateFormatTransform.reformat, takes unix timestamps or ISO
+	date strings and returns SQL formatted date strings, "" for None.
+	"""
+	result = numpy.empty(len(values), dtype=object)
+	result.fill("")
+	present = numpy.array([value is not None for value in values], dtype=bool)
+	if not present.any():
+		return result
+	strings = numpy.array([value for value in values if value is not None], dtype=unicode)
+	iso = numpy.char.find(strings, u"T") >= 0
+	dates = numpy.empty(len(strings), dtype="datetime64[s]")
+	if iso.any():
+		dates[iso] = strings[iso].astype("datetime64[us]").astype("datetime64[s]")
+	if not iso.all():
+		seconds = strings[~iso].astype(float)
+		dates[~iso] = (seconds * 1e6).astype(numpy.int64).astype("datetime64[us]").astype("datetime64[s]")
+	result[present] = numpy.char.replace(numpy.datetime_as_string(dates), "T", " ")
+	return result
+
+
+def join_ids(*columns):
+	"""
+	Vectorized "%s_%s_%s" % row over the given columns.
+	"""
+	result = numpy.array(columns[0], dtype=unicode)
+	for column in columns[1:]:
+		result = numpy.char.add(numpy.char.add(result, u"_"), numpy.array(column, dtype=unicode))
+	return result
+
+
+class ColumnarActionsSerializer(AbstractTransformer):
+	"""
+	Columnar form of ActionsSerializer followed by SQLDateFormatTransform on
+	created and deleted. Each page becomes one ColumnBatch with the columns
+	action_id, board_id, uid, oid, action, created and deleted; board_id is
+	None for object actions.
+	"""
+	def handle(self, node_type, id, node):
+		return [row for row_id, row in self.handle_columns(node_type, [(id, node)]).rows()]
+
+	def handle_batch(self, node_type, items):
+		return self.handle_columns(node_type, items).rows()
+
+	def handle_columns(self, node_type, items):
+		ids, targets, board_ids, uids, oids, actions, created, deleted = [], [], [], [], [], [], [], []
+		for id, node in items:
+			user_id = node.get("id")
+			user_boards = node.get("user_boards", {})
+			brand_boards = node.get("brand_boards", {})
+			for board_id, board_actions in user_boards.items() + brand_boards.items():
+				for action in board_actions:
+					ids.append(id)
+					targets.append(board_id)
+					board_ids.append(board_id)
+					uids.append(user_id)
+					oids.append(action.get("object"))
+					actions.append(action.get("name"))
+					created.append(action["created"])
+					deleted.append(action.get("deleted"))
+			objects = node.get("objects", [])
+			for object_id in objects:
+				for action in objects.get(object_id, []):
+					ids.append(id)
+					targets.append(object_id)
+					board_ids.append(None)
+					uids.append(user_id)
+					oids.append(object_id)
+					actions.append(action.get("name"))
+					created.append(action.get("created"))
+					deleted.append(action.get("deleted"))
+		if not ids:
+			return ColumnBatch({}, ids)
+		return ColumnBatch({
+			"action_id": join_ids(uids, actions, targets),
+			"board_id": board_ids,
+			"uid": uids,
+			"oid": oids,
+			"action": actions,
+			"created": sql_dates(created),
+			"deleted": sql_dates(deleted),
+		}, ids)
@@ -0,0 +1,134 @@
+"""
+Fast parsing of the date formats found in the feeds: unix timestamps (with an
+optional fraction), ISO 8601 without a timezone, SQL formatted dates and US
+style m/d/Y dates.
+ISO dates are sliced by hand rather than going through strptime.
+"""
+from collections import OrderedDict
+from datetime import datetime
+
+
+def parse_epoch(value):
+	if not isinstance(value, basestring):
+		return datetime.utcfromtimestamp(float(value))
+	whole, _, fraction = value.partition(".")
+	ts = datetime.utcfromtimestamp(float(whole))
+	if fraction:
+		if not fraction.isdigit():
+			raise ValueError("invalid timestamp %r" % value)
+		ts = ts.replace(microsecond=int(fraction[:6].ljust(6, "0")))
+	return ts
+
+
+def parse_iso(value):
+	"""
+	Parses %Y-%m-%dT%H:%M:%S with optional .%f
+	"""
+	if (len(value) < 19 or value[4] != "-" or value[7] != "-" or value[10] != "T"
+			or value[13] != ":" or value[16] != ":"):
+		raise ValueError("invalid ISO date %r" % value)
+	microsecond = 0
+	if len(value) > 19:
+		fraction = value[20:]
+		if value[19] != "." or not 0 < len(fraction) <= 6 or not fraction.isdigit():
+			raise ValueError("invalid ISO date %r" % value)
+		microsecond = int(fraction.ljust(6, "0"))
+	return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+		int(value[11:13]), int(value[14:16]), int(value[17:19]), microsecond)
+
+
+def parse_sql(value):
+	"""
+	Parses %Y-%m-%d %H:%M:%S, as written by format_sql
+	"""
+	if len(value) != 19 or value[10] != " ":
+		raise ValueError("invalid SQL date %r" % value)
+	return parse_iso(value[:10] + "T" + value[11:])
+
+
+def parse_us_date(value):
+	"""
+	Parses %m/%d/%Y
+	"""
+	parts = value.split("/")
+	if len(parts) != 3 or len(parts[2]) != 4:
+		raise ValueError("invalid date %r" % value)
+	return datetime(int(parts[2]), int(parts[0]), int(parts[1]))
+
+
+def format_sql(dte):
+	return "%04d-%02d-%02d %02d:%02d:%02d" % (dte.year, dte.month, dte.day, dte.hour, dte.minute, dte.second)
+
+
+PARSERS = {
+	"epoch": parse_epoch,
+	"iso": parse_iso,
+	"sql": parse_sql,
+	"us": parse_us_date,
+}
+
+
+class DateParser(object):
+	"""
+	Parses dates trying each of formats in turn, and remembers per field
+	which format matched so later values of the field go straight to it.
+	Formatted SQL dates are kept in a bounded LRU cache, since the same
+	timestamps tend to repeat across the rows of a page.
+	"""
+	formats = ("epoch", "iso")
+	cache_size = 4096
+
+	def __init__(self, formats=None, cache_size=None):
+		if formats:
+			self.formats = tuple(formats)
+		if cache_size is not None:
+			self.cache_size = cache_size
+		self.field_formats = {}
+		self.cache = OrderedDict()
+
+	def parse(self, value, field=None, formats=None):
+		"""
+		Returns a datetime, raises ValueError if no format matches.
+		"""
+		formats = formats or self.formats
+		known = self.field_formats.get(field)
+		if known is not None:
+			try:
+				return PARSERS[known](value)
+			except (ValueError, TypeError):
+				pass
+		for name in formats:
+			try:
+				result = PARSERS[name](value)
+			except (ValueError, TypeError):
+				continue
+			if field is not None:
+				self.field_formats[field] = name
+			return result
+		raise ValueError("unrecognized date %r" % (value,))
+
+	def parse_or_none(self, value, field=None, formats=None):
+		if not value:
+			return None
+		try:
+			return self.parse(value, field, formats)
+		except ValueError:
+			return None
+
+	def format_sql(self, value, field=None):
+		"""
+		Parses value and returns it as an SQL formatted date string.
+		"""
+		cache = self.cache
+		try:
+			# Re-insert to mark as most recently used
+			formatted = cache.pop(value)
+		except KeyError:
+			formatted = format_sql(self.parse(value, field))
+			if cache and len(cache) >= self.cache_size:
+				cache.popitem(last=False)
+		except TypeError:
+			# Unhashable values are not cached
+			return format_sql(self.parse(value, field))
+		cache[value] = formatted
+		return formatted
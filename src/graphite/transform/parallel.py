@@ -0,0 +1,88 @@
+"""
+ParallelTransformer shards each page across a pool of worker processes and
+runs the wrapped transformer (e.g. a TransformerChain) in the workers, so
+transform heavy feeds can use every core. The wrapped transformer has to be
+picklable on platforms that don't fork.
+"""
+import collections
+import multiprocessing
+
+from graphite.load.base import chunks
+from graphite.transform.base import AbstractTransformer, handle_batch, flatten_results
+
+
+_worker_transformer = None
+
+
+def _init_worker(transformer):
+	global _worker_transformer
+	_worker_transformer = transformer
+
+
+def _transform_chunk(task):
+	node_type, chunk = task
+	# Generators don't pickle, send back the expanded (id, node) pairs
+	return list(flatten_results(handle_batch(_worker_transformer, node_type, chunk)))
+
+
+class ParallelTransformer(AbstractTransformer):
+	"""
+	Runs transformer over chunks of chunk_size records in a process pool.
+	Results come back in page order unless ordered is False, in which case
+	chunks are passed on as soon as they are done. At most two chunks per
+	process are in flight at a time.
+
+	The pool is forked in the constructor, before the extractor starts its
+	prefetch, writer and feed threads: children forked while other threads
+	hold locks can deadlock. Call close() when the load is finished to shut
+	the pool down.
+	"""
+	transformer = None
+	processes = None
+	chunk_size = 200
+	ordered = True
+
+	def __init__(self, transformer, processes=None, chunk_size=None, ordered=True):
+		self.transformer = transformer
+		self.processes = processes or multiprocessing.cpu_count()
+		if chunk_size:
+			self.chunk_size = chunk_size
+		self.ordered = ordered
+		self.pool = multiprocessing.Pool(self.processes, _init_worker, (self.transformer,))
+
+	def handle(self, node_type, id, node):
+		# Single records aren't worth the trip to a worker
+		return self.transformer.handle(node_type, id, node)
+
+	def handle_batch(self, node_type, items):
+		pool = self.pool
+		if pool is None:
+			raise ValueError("ParallelTransformer is closed")
+		# Keep a bounded number of chunks in flight, items are only pulled as
+		# results are consumed so memory stays bounded
+		window = self.processes * 2
+		pending = collections.deque()
+		for chunk in chunks(items, self.chunk_size):
+			pending.append(pool.apply_async(_transform_chunk, ((node_type, chunk),)))
+			while len(pending) >= window:
+				for pair in self._next_result(pending):
+					yield pair
+		while pending:
+			for pair in self._next_result(pending):
+				yield pair
+
+	def _next_result(self, pending):
+		if self.ordered:
+			return pending.popleft().get()
+		while True:
+			for result in pending:
+				if result.ready():
+					pending.remove(result)
+					return result.get()
+			pending[0].wait(0.05)
+
+	def close(self):
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
@@ -1,6 +1,7 @@
 from graphite.transform import AbstractTransformer
 from datetime import datetime
 from graphite import NODE_TYPE_USER
+from graphite.transform.dates import DateParser, parse_epoch, format_sql
 
 
 def flatten_dict(source, prefix=None):
@@ -18,10 +19,68 @@ def flatten_dict(source, prefix=None):
 	return result
 
 
+def compile_paths(paths):
+	"""
+	Builds a trie from . separated key paths. Each level maps a key to
+	(path, children), path is the full key path when one ends at that key.
+	"""
+	trie = {}
+	for path in paths:
+		level = trie
+		names = path.split(".")
+		for i, name in enumerate(names):
+			end, children = level.get(name, (None, None))
+			if i == len(names) - 1:
+				end = path
+			elif children is None:
+				children = {}
+			level[name] = (end, children)
+			if children is not None:
+				level = children
+	return trie
+
+
+def project_dict(source, trie, result):
+	"""
+	Copies only the leaf values named in the trie into result, under their
+	flat key path, without visiting any other branch of source.
+	"""
+	for name, (path, children) in trie.iteritems():
+		if name in source:
+			value = source[name]
+			if isinstance(value, dict):
+				if children:
+					project_dict(value, children, result)
+			elif path is not None:
+				result[path] = value
+	return result
+
+
+def flatten_dict_excluding(source, trie, result, prefix=None):
+	"""
+	flatten_dict that leaves out the paths in the trie, an excluded path that
+	names a nested dict drops its whole subtree.
+	"""
+	for name in source:
+		value = source[name]
+		pathed = prefix + "." + name if prefix else name
+		entry = trie.get(name) if trie else None
+		if entry is not None and entry[0] is not None:
+			continue
+		if isinstance(value, dict):
+			flatten_dict_excluding(value, entry[1] if entry else None, result, pathed)
+		else:
+			result[pathed] = value
+	return result
+
+
 class FlatMapper(AbstractTransformer):
 	"""
 	Turns the node into a flat dict with . separated key paths.
-	Optionally pass in includes or excludes to filter the results.
+	Optionally pass in includes or excludes to filter the results. Both are
+	compiled into a trie up front, so only the included branches of a node
+	are walked and excluded branches are skipped. Keys that themselves
+	contain a . are matched by their nesting, not by the literal key.
 	"""
 	includes = None
 	excludes = None
@@ -33,22 +92,28 @@ class FlatMapper(AbstractTransformer):
 			self.excludes = excludes
 		if includes and excludes:
 			raise Exception("can't include when you are also excluding")
+		self.include_trie = compile_paths(self.includes or ())
+		self.exclude_trie = compile_paths(self.excludes or ())
 
 	def handle(self, node_type, id, node):
-		flat = flatten_dict(node)
-		result = dict()
-		# I suspect there is a better way to do this, but for now this is what we get.
-		if self.includes:
-			for key in flat:
-				if key in self.includes:
-					result[key] = flat[key]
-		elif self.excludes:
-			for key in flat:
-				if key not in self.excludes:
-					result[key] = flat[key]
+		if self.include_trie:
+			return project_dict(node, self.include_trie, {})
+		elif self.exclude_trie:
+			return flatten_dict_excluding(node, self.exclude_trie, {})
+		return flatten_dict(node)
+
+	def handle_batch(self, node_type, items):
+		if self.include_trie:
+			trie = self.include_trie
+			for id, node in items:
+				yield id, project_dict(node, trie, {})
+		elif self.exclude_trie:
+			trie = self.exclude_trie
+			for id, node in items:
+				yield id, flatten_dict_excluding(node, trie, {})
 		else:
-			result = flat
-		return result
+			for id, node in items:
+				yield id, flatten_dict(node)
 
 
 class UsersFriendsTransformer(AbstractTransformer):
@@ -65,6 +130,20 @@ class UsersFriendsTransformer(AbstractTransformer):
 		else:
 			yield node
 
+	def handle_batch(self, node_type, items):
+		# Yields one (id, edge) pair per friend
+		if node_type != NODE_TYPE_USER:
+			for id, node in items:
+				yield id, node
+			return
+		for id, node in items:
+			user_id = node.get("id")
+			for friend in node.get("friends", []):
+				if isinstance(friend, dict):
+					yield id, {"id": user_id, "friend": friend.get("id")}
+				else:
+					yield id, {"id": user_id, "friend": friend}
+
 
 class SQLDateFormatTransform(AbstractTransformer):
 	"""
@@ -77,39 +156,37 @@ class SQLDateFormatTransform(AbstractTransformer):
 			self.fields = fields
 		else:
 			self.fields = list()
+		self.parser = DateParser()
 
 	def handle(self, node_type, id, node):
 		if self.fields:
 			for field in self.fields:
 				if field in node:
-					node[field] = self.reformat(node[field])
+					node[field] = self.reformat(node[field], field)
 		return node
 
+	def handle_batch(self, node_type, items):
+		fields = self.fields
+		reformat = self.reformat
+		for id, node in items:
+			for field in fields:
+				if field in node:
+					node[field] = reformat(node[field], field)
+			yield id, node
+
 	def get_datetime(self, val):
 		"""
 		Tiny helper to let us use microsecond precision unix timestamps and
 		conver to a python datetime.
 		"""
-		parts = val.split(".")
-		ts = datetime.utcfromtimestamp(float(parts[0]))
-		if len(parts) == 2:
-			ts = ts.replace(microsecond=int(parts[1]))
-		return ts
-	def parsedate(self, date_string):
-		try:
-			return self.get_datetime(date_string)
-		except:
-			pass
-		try:
-			return datetime.strptime(date_string, "%Y-%m-%dT%H:%M:%S")
-		except:
-			return datetime.strptime(date_string, "%Y-%m-%dT%H:%M:%S.%f")
-
-	def reformat(self, value):
+		return parse_epoch(val)
+
+	def parsedate(self, date_string, field=None):
+		return self.parser.parse(date_string, field)
+
+	def reformat(self, value, field=None):
 		if value is None:
 			return ""
-		if not isinstance(value, datetime):
-			dte = self.parsedate(value)
-		else:
-			dte = value
-		return datetime.strftime(dte, '%Y-%m-%d %H:%M:%S')
+		if isinstance(value, datetime):
+			return format_sql(value)
+		return self.parser.format_sql(value, field)